@@ -0,0 +1,76 @@
+"""SMTP投递相关的回归测试：错误分类和并行投递"""
+import os
+import smtplib
+import socket
+import ssl
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from weather_email_clean import DeliveryEngine, SMTPPool, is_transient_smtp_error
+
+
+class TransientErrorTest(unittest.TestCase):
+    def test_transient(self):
+        for error in (smtplib.SMTPServerDisconnected(), socket.timeout(), ConnectionResetError(),
+                      smtplib.SMTPResponseException(451, b'try later'),
+                      smtplib.SMTPRecipientsRefused({'a@example.com': (450, b'busy')})):
+            with self.subTest(error=repr(error)):
+                self.assertTrue(is_transient_smtp_error(error))
+
+    def test_permanent(self):
+        for error in (smtplib.SMTPNotSupportedError('STARTTLS extension not supported by server.'),
+                      smtplib.SMTPException('No suitable authentication method found.'),
+                      ssl.SSLCertVerificationError('certificate verify failed'),
+                      smtplib.SMTPAuthenticationError(535, b'bad credentials'),
+                      smtplib.SMTPResponseException(550, b'mailbox unavailable'),
+                      smtplib.SMTPRecipientsRefused({'a@example.com': (550, b'no such user')})):
+            with self.subTest(error=repr(error)):
+                self.assertFalse(is_transient_smtp_error(error))
+
+
+class FakeSession:
+    """记录发送的收件人，不连接网络"""
+
+    def __init__(self, sent):
+        self.sent = sent
+
+    def send(self, from_addr, to_addrs, message):
+        self.sent.extend(to_addrs)
+
+    def close(self):
+        pass
+
+
+class DeliveryEngineTest(unittest.TestCase):
+    def deliver(self, emails, on_result):
+        sent = []
+        engine = DeliveryEngine(SMTPPool(lambda: FakeSession(sent)), workers=3, retry_delay=0)
+        outcome = []
+        thread = threading.Thread(target=lambda: outcome.append(
+            engine.deliver('from@example.com', emails, lambda email: b'message', on_result)), daemon=True)
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive(), 'deliver() 没有返回')
+        return outcome[0], sent
+
+    def test_on_result_failure_does_not_hang_or_miscount(self):
+        emails = [f'user{i}@example.com' for i in range(10)]
+        recorded = []
+
+        def on_result(index, result):
+            if index == 0:
+                raise RuntimeError('database is locked')
+            recorded.append(index)
+
+        results, sent = self.deliver(emails, on_result)
+        self.assertEqual([result.success for result in results], [True] * 10)
+        self.assertEqual([result.attempts for result in results], [1] * 10)
+        self.assertEqual(sorted(sent), sorted(emails))
+        self.assertEqual(sorted(recorded), list(range(1, 10)))
+
+
+if __name__ == '__main__':
+    unittest.main()
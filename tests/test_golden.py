@@ -0,0 +1,140 @@
+"""邮件渲染和穿衣建议的回归测试：与 tests/golden 下保存的输出逐字节对比
+
+时钟固定为北京时间 2024-05-02 06:00，贴心提醒固定为 DAILY_TIPS[0]。
+渲染有意变化时用 UPDATE_GOLDEN=1 python -m unittest discover -s tests 重新生成并检查差异。
+"""
+import os
+import sys
+import unittest
+from datetime import datetime
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import weather_email_clean
+from weather_email_clean import DAILY_TIPS, WeatherEmail, WeatherReport
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+
+
+class FixedDatetime(datetime):
+    """固定时钟：北京时间 2024-05-02 06:00"""
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2024, 5, 2, 6, 0, 0)
+
+    @classmethod
+    def utcnow(cls):
+        return cls(2024, 5, 1, 22, 0, 0)
+
+
+CURRENT = {'temp': '18', 'text': '多云', 'windDir': '东南风', 'windScale': '3', 'humidity': '65', 'vis': '16'}
+FORECAST = [
+    {'fxDate': '2024-05-02', 'tempMin': '12', 'tempMax': '24', 'textDay': '晴', 'textNight': '多云',
+     'windDirDay': '南风', 'windScaleDay': '1-3'},
+    {'fxDate': '2024-05-03', 'tempMin': '13', 'tempMax': '22', 'textDay': '小雨', 'textNight': '阴',
+     'windDirDay': '东风', 'windScaleDay': '1-3'},
+    {'fxDate': '2024-05-04', 'tempMin': '11', 'tempMax': '20', 'textDay': '多云', 'textNight': '晴',
+     'windDirDay': '北风', 'windScaleDay': '3-4'}
+]
+
+CASES = {
+    'cloudy_aqi_0': {'current': CURRENT, 'forecast': FORECAST, 'air_quality': {'aqi': '0'}},
+    'sunny_hot_dry': {'current': dict(CURRENT, text='晴', temp='33', humidity='20'), 'forecast': FORECAST,
+                      'air_quality': {'aqi': '50'}},
+    'rain_polluted': {'current': dict(CURRENT, text='雷阵雨', temp='23', humidity='90'), 'forecast': FORECAST,
+                      'air_quality': {'aqi': '160'}},
+    'snow_no_air_quality': {'current': dict(CURRENT, text='大雪', temp='-5', windScale='5'),
+                            'forecast': FORECAST[:1], 'air_quality': None},
+    'missing_fields': {'current': {'temp': '3'}, 'forecast': [], 'air_quality': {'aqi': ''}},
+    'hourly_rain_yesterday': {'current': CURRENT, 'forecast': FORECAST, 'air_quality': {'aqi': '80'},
+                              'hourly': [{'fxTime': '2024-05-02T07:00+08:00', 'text': '多云', 'pop': '10'},
+                                         {'fxTime': '2024-05-02T08:00+08:00', 'text': '小雨', 'pop': '70'}],
+                              'yesterday_temp': 24}
+}
+
+ADVICE = {
+    'cloudy_aqi_0': ["👕 建议穿长袖衬衫、薄毛衣或薄外套", "👖 可以穿长裤或薄款休闲裤", "🫁 空气质量优良，适合户外活动"],
+    'sunny_hot_dry': ["👕 建议穿清爽的短袖、薄款衣物", "🌡️ 天气较热，选择透气性好的衣物",
+                      "☀️ 晴天阳光强，建议做好防晒措施", "🕶️ 可以准备太阳镜和防晒霜",
+                      "💧 空气干燥，注意补水和润肤", "📈 气温变化较大，建议准备备用衣物",
+                      "🫁 空气质量优良，适合户外活动"],
+    'rain_polluted': ["👕 建议穿长袖T恤、衬衫或薄外套", "☀️ 温度适宜，注意适当增减衣物",
+                      "☔ 记得带雨伞，选择防水外套", "👟 建议穿防滑鞋，避免穿容易湿透的鞋子",
+                      "💧 湿度较高，选择透气吸汗的材质", "📈 气温变化较大，建议准备备用衣物",
+                      "😷 空气质量较差，建议佩戴口罩", "🏠 空气污染严重，减少户外活动"],
+    'snow_no_air_quality': ["🧥 建议穿厚羽绒服、棉衣，做好防寒保暖", "🧤 记得戴帽子、手套、围巾",
+                            "❄️ 雪天路滑，穿防滑保暖的鞋子", "🧥 选择防风防水的外套",
+                            "📈 气温变化较大，建议准备备用衣物"],
+    'missing_fields': ["🧥 建议穿厚外套、毛衣或薄羽绒服", "👖 可以穿厚裤子或加绒裤"],
+    'hourly_rain_yesterday': ["👕 建议穿长袖衬衫、薄毛衣或薄外套", "👖 可以穿长裤或薄款休闲裤",
+                              "🥶 比昨天同一时间冷6°C，注意添衣"]
+}
+
+
+class GoldenOutputTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(weather_email_clean, 'datetime', FixedDatetime)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.weather_email = WeatherEmail(config={})
+
+    def test_format_weather_html(self):
+        for name, weather_data in CASES.items():
+            with self.subTest(name):
+                html = self.weather_email.format_weather_html(WeatherReport.from_dict(weather_data), DAILY_TIPS[0])
+                path = os.path.join(GOLDEN_DIR, f'{name}.html')
+                if os.environ.get('UPDATE_GOLDEN'):
+                    with open(path, 'w', encoding='utf-8', newline='') as f:
+                        f.write(html)
+                with open(path, 'r', encoding='utf-8', newline='') as f:
+                    self.assertEqual(html, f.read())
+
+    def test_match_advice_rules(self):
+        for name, weather_data in CASES.items():
+            with self.subTest(name):
+                advice = self.weather_email.match_advice_rules(WeatherReport.from_dict(weather_data))
+                self.assertEqual(advice, ADVICE[name])
+
+    def test_clothing_advice_appends_tip(self):
+        advice = self.weather_email.get_clothing_advice(WeatherReport.from_dict(CASES['cloudy_aqi_0']), DAILY_TIPS[0])
+        self.assertEqual(advice, ADVICE['cloudy_aqi_0'] + [DAILY_TIPS[0]])
+
+
+class RenderKeyTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(weather_email_clean, 'datetime', FixedDatetime)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.weather_email = WeatherEmail(config={'email_user': 'from@example.com'})
+
+    def render(self, weather_data):
+        return self.weather_email.render_message(WeatherReport.from_dict(weather_data), DAILY_TIPS[0])
+
+    def test_hidden_fields_share_render(self):
+        base = CASES['cloudy_aqi_0']
+        key, message = self.render(dict(base, current=dict(CURRENT, obsTime='2024-05-02T10:02+08:00')))
+        for variant in (dict(base, current=dict(CURRENT, obsTime='2024-05-02T10:05+08:00')),
+                        dict(base, air_quality={'aqi': '0', 'category': '优'})):
+            with self.subTest(variant=variant):
+                self.assertEqual(self.render(variant)[0], key)
+        self.assertEqual(self.weather_email.render_cache.misses, 1)
+
+        # 只显示前4天预报，7天预报多出的几天不影响
+        four_days = FORECAST + [dict(FORECAST[2], fxDate='2024-05-05')]
+        key, _ = self.render(dict(base, forecast=four_days))
+        seven_days = four_days + [dict(FORECAST[1], fxDate=f'2024-05-0{day}') for day in (6, 7, 8)]
+        self.assertEqual(self.render(dict(base, forecast=seven_days))[0], key)
+
+    def test_displayed_fields_change_render(self):
+        key, _ = self.render(CASES['cloudy_aqi_0'])
+        for variant in (dict(CASES['cloudy_aqi_0'], current=dict(CURRENT, vis='10')),
+                        dict(CASES['cloudy_aqi_0'], air_quality={'aqi': '1'}),
+                        CASES['hourly_rain_yesterday']):
+            with self.subTest(variant=variant):
+                self.assertNotEqual(self.render(variant)[0], key)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""本地持久化的回归测试：原子写文件、响应缓存和发件队列"""
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from weather_email_clean import DeliveryResult, EncodedMessage, MailSpool, ResponseCache, write_file_atomic
+
+
+class WriteFileAtomicTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_concurrent_writes(self):
+        path = os.path.join(self.directory.name, 'state.json')
+        errors = []
+
+        def writer(index):
+            for round_index in range(30):
+                try:
+                    write_file_atomic(path, json.dumps([index, round_index]))
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=writer, args=(index,)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(self.directory.name), ['state.json'])
+        self.assertEqual(json.load(open(path, encoding='utf-8'))[1], 29)
+
+    def test_concurrent_cache_saves_keep_latest(self):
+        path = os.path.join(self.directory.name, 'cache.json')
+        cache = ResponseCache(cache_file=path)
+
+        def saver(index):
+            for round_index in range(20):
+                cache.set('weather/now', f'{index}-{round_index}', {'code': '200'})
+                cache.save()
+
+        threads = [threading.Thread(target=saver, args=(index,)) for index in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(ResponseCache(cache_file=path)._entries), 80)
+
+
+class MailSpoolTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.spool = MailSpool(os.path.join(directory.name, 'spool.db'))
+        self.addCleanup(self.spool.close)
+        self.message = EncodedMessage('from@example.com', '天气', '<p>晴</p>')
+
+    def count(self, table):
+        return self.spool.conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+    def test_prune_removes_expired_runs_and_bodies(self):
+        rows = self.spool.enqueue('2024-05-01', [(['a@example.com', 'b@example.com'], self.message)])[0]
+        for message_id, email in rows:
+            self.spool.record(message_id, DeliveryResult(email, success=True, attempts=1))
+        self.spool.flush()
+        self.spool.conn.execute('UPDATE messages SET updated_at = ?', (time.time() - 8 * 86400,))
+        self.spool.enqueue('2024-05-09', [(['a@example.com'], self.message)])
+        # 收件人都已入队时也会写入一份正文，没有记录引用它
+        self.spool.enqueue('2024-05-09', [(['a@example.com'], self.message)])
+        self.assertEqual(self.count('bodies'), 3)
+
+        self.assertEqual(self.spool.prune(7 * 86400), 2)
+        self.assertEqual(self.count('messages'), 1)
+        self.assertEqual(self.count('bodies'), 1)
+        self.assertEqual(self.spool.known_recipients('2024-05-01'), set())
+        self.assertEqual([[email for _, email in rows] for _, rows in self.spool.unsent('2024-05-09')],
+                         [['a@example.com']])
+
+    def test_prune_keeps_recent_runs(self):
+        self.spool.enqueue('2024-05-09', [(['a@example.com'], self.message)])
+        self.assertEqual(self.spool.prune(7 * 86400), 0)
+        self.assertEqual(self.count('messages'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,27 +2,1499 @@
 """
 小麻雀天气助手 - 免费邮件天气通知系统（含AQI空气质量）
 使用Gmail、QQ邮箱等免费邮箱服务发送天气邮件
+
+启动较慢的模块（requests、asyncio、smtplib、email.mime、sqlite3、http.server）只在用到的地方导入，
+只渲染不发送（dry-run）或查看帮助时不会加载
 """
-import requests
-import schedule
 import time
 import json
-import smtplib
-from datetime import datetime
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.header import Header
+from datetime import datetime, timedelta
+import hashlib
+import heapq
 import logging
+import os
 import random
+import re
+import socket
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 每次获取天气需要请求的和风天气接口（默认配置下）
+WEATHER_ENDPOINTS = ('weather/now', 'weather/3d', 'air/now')
+
+# 各接口响应的默认缓存时间（秒）：实况和空气质量较短，预报较长
+DEFAULT_CACHE_TTL = {
+    'weather/now': 600,
+    'weather/3d': 3 * 3600,
+    'weather/7d': 3 * 3600,
+    'weather/24h': 3600,
+    'air/now': 1800
+}
+
+# 耗时直方图的默认分桶（秒）
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metrics:
+    """轻量的运行指标：计数器和耗时直方图，可导出为 Prometheus 文本格式或 JSON 摘要"""
+    
+    def __init__(self, prefix='weather_email', buckets=DEFAULT_LATENCY_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self._counters = {}  # (名称, 标签) -> 数值
+        self._histograms = {}  # (名称, 标签) -> [各分桶计数, 总和, 次数, 最大值]
+        self._lock = threading.Lock()
+    
+    def inc(self, name, value=1, **labels):
+        """计数器加 value"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+    
+    def observe(self, name, seconds, **labels):
+        """记录一次耗时"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0, 0.0]
+            index = bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+            histogram[3] = max(histogram[3], seconds)
+    
+    @contextmanager
+    def timer(self, name, **labels):
+        """统计 with 代码块的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+    
+    def format_labels(self, labels, extra=()):
+        """格式化 Prometheus 标签 {a="1",b="2"}"""
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                   for _, value in pairs)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+    
+    def to_prometheus(self):
+        """导出为 Prometheus 文本格式"""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(value[0]),) + tuple(value[1:]))
+                                for key, value in self._histograms.items())
+        
+        lines = []
+        declared = set()
+        for (name, labels), value in counters:
+            metric = f"{self.prefix}_{name}"
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{self.format_labels(labels)} {value}")
+        
+        for (name, labels), (bucket_counts, total, count, _) in histograms:
+            metric = f"{self.prefix}_{name}"
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{metric}_bucket{self.format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{metric}_bucket{self.format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{metric}_sum{self.format_labels(labels)} {total}")
+            lines.append(f"{metric}_count{self.format_labels(labels)} {count}")
+        
+        return '\n'.join(lines) + '\n'
+    
+    def summary(self):
+        """导出为 JSON 友好的摘要"""
+        with self._lock:
+            counters = {name + self.format_labels(labels): value
+                        for (name, labels), value in sorted(self._counters.items())}
+            timings = {name + self.format_labels(labels): {
+                           'count': count,
+                           'total_seconds': round(total, 6),
+                           'avg_seconds': round(total / count, 6) if count else 0,
+                           'max_seconds': round(maximum, 6)
+                       }
+                       for (name, labels), (_, total, count, maximum) in sorted(self._histograms.items())}
+        return {'counters': counters, 'timings': timings}
+    
+    def serve(self, port, host='127.0.0.1'):
+        """在后台线程中通过 HTTP 提供 /metrics"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        httpd = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=httpd.serve_forever, name='metrics-http', daemon=True).start()
+        logger.info(f"指标服务已启动: http://{host}:{httpd.server_address[1]}/metrics")
+        return httpd
+
+def write_file_atomic(path, text):
+    """先写临时文件再替换，避免读到写了一半的文件
+    
+    临时文件名带进程和线程标识，多个线程或进程同时写同一路径时互不影响
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+@lru_cache(maxsize=64)
+def load_timezone(name):
+    """按名称加载时区（如 Asia/Shanghai）
+
+    Windows 等没有系统时区数据库、也没有安装 tzdata 时无法加载，这时记录警告并使用本机时区
+    """
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError) as e:
+        logger.warning(f"无法加载时区 {name}，使用本机时区（可以 pip install tzdata）: {e}")
+        return datetime.now().astimezone().tzinfo
+
+def parse_int(value):
+    """接口返回的数字字符串转为 int，缺失或无法解析时返回 None"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def parse_float(value):
+    """接口返回的数字字符串转为 float，缺失或无法解析时返回 None"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def parse_text(value):
+    return None if value is None else str(value)
+
+def observation_time(obs_time):
+    """接口的观测时间（如 2024-05-01T10:00+08:00）转为时间戳，无法解析时使用当前时间"""
+    try:
+        return datetime.fromisoformat(obs_time).timestamp()
+    except (TypeError, ValueError):
+        return time.time()
+
+def hour_has_passed(fx_time, now):
+    """逐小时预报的时间（如 2024-05-01T15:00+08:00）是否已经过去，now 需带时区"""
+    try:
+        at = datetime.fromisoformat(fx_time)
+    except (TypeError, ValueError):
+        return False
+    if at.tzinfo is None:
+        at = at.astimezone()
+    return at < now
+
+class ApiRecord:
+    """接口数据记录的基类
+    
+    FIELDS 为 (属性名, 接口字段名, 解析函数)，解析时数值字段一次转换好，缺失的字段为 None；
+    使用 __slots__，缓存几百个城市的数据时比嵌套的字符串字典省内存
+    """
+    
+    __slots__ = ()
+    FIELDS = ()
+    
+    @classmethod
+    def from_api(cls, data):
+        record = cls.__new__(cls)
+        get = data.get
+        for attr, key, parse in cls.FIELDS:
+            setattr(record, attr, parse(get(key)))
+        return record
+    
+    def to_api(self):
+        """还原为接口格式的字典（用于持久化快照和计算渲染缓存的键）"""
+        data = {}
+        for attr, key, _ in self.FIELDS:
+            value = getattr(self, attr)
+            if value is not None:
+                data[key] = str(value)
+        return data
+    
+    def __repr__(self):
+        fields = ', '.join(f"{attr}={getattr(self, attr)!r}" for attr, _, _ in self.FIELDS)
+        return f"{type(self).__name__}({fields})"
+
+class CurrentWeather(ApiRecord):
+    """实况天气（weather/now）"""
+    
+    __slots__ = ('obs_time', 'temp', 'text', 'wind_dir', 'wind_scale', 'humidity', 'vis')
+    FIELDS = (
+        ('obs_time', 'obsTime', parse_text),
+        ('temp', 'temp', parse_int),
+        ('text', 'text', parse_text),
+        ('wind_dir', 'windDir', parse_text),
+        ('wind_scale', 'windScale', parse_int),
+        ('humidity', 'humidity', parse_int),
+        ('vis', 'vis', parse_int)
+    )
+
+class DailyForecast(ApiRecord):
+    """逐天预报（weather/3d、weather/7d）"""
+    
+    __slots__ = ('date', 'temp_min', 'temp_max', 'text_day', 'text_night', 'wind_dir_day', 'wind_scale_day')
+    FIELDS = (
+        ('date', 'fxDate', parse_text),
+        ('temp_min', 'tempMin', parse_int),
+        ('temp_max', 'tempMax', parse_int),
+        ('text_day', 'textDay', parse_text),
+        ('text_night', 'textNight', parse_text),
+        ('wind_dir_day', 'windDirDay', parse_text),
+        ('wind_scale_day', 'windScaleDay', parse_text)  # 形如 "1-3"，保留原文
+    )
+
+class HourlyForecast(ApiRecord):
+    """逐小时预报（weather/24h）"""
+    
+    __slots__ = ('time', 'temp', 'text', 'pop', 'precip')
+    FIELDS = (
+        ('time', 'fxTime', parse_text),
+        ('temp', 'temp', parse_int),
+        ('text', 'text', parse_text),
+        ('pop', 'pop', parse_int),  # 降水概率（%）
+        ('precip', 'precip', parse_float)  # 降水量（毫米）
+    )
+    
+    def is_rainy(self, pop_threshold):
+        """这一小时是否可能下雨：天气描述含雨/雷、有降水量，或降水概率达到阈值"""
+        return bool(RAIN_PATTERN.search(self.text or '')
+                    or (self.precip or 0) > 0
+                    or (self.pop is not None and self.pop >= pop_threshold))
+
+class AirQuality(ApiRecord):
+    """空气质量（air/now）"""
+    
+    __slots__ = ('aqi', 'category')
+    FIELDS = (
+        ('aqi', 'aqi', parse_int),
+        ('category', 'category', parse_text)
+    )
+
+class WeatherReport:
+    """一个城市的天气：实况、逐天预报、逐小时预报和空气质量，接口数据只解析一次"""
+    
+    __slots__ = ('current', 'forecast', 'hourly', 'air_quality', 'stale_since', 'yesterday_temp')
+    
+    def __init__(self, current, forecast=(), hourly=(), air_quality=None, stale_since=None, yesterday_temp=None):
+        self.current = current
+        self.forecast = list(forecast)
+        self.hourly = list(hourly)
+        self.air_quality = air_quality
+        self.stale_since = stale_since
+        self.yesterday_temp = yesterday_temp  # 历史记录中昨天同一时间的温度
+    
+    @classmethod
+    def from_dict(cls, data):
+        """由接口格式的字典 {"current", "forecast", "hourly", "air_quality", "stale_since", "yesterday_temp"} 解析"""
+        return cls(CurrentWeather.from_api(data.get('current') or {}),
+                   [DailyForecast.from_api(day) for day in data.get('forecast') or ()],
+                   [HourlyForecast.from_api(hour) for hour in data.get('hourly') or ()],
+                   AirQuality.from_api(data['air_quality']) if data.get('air_quality') else None,
+                   data.get('stale_since'),
+                   data.get('yesterday_temp'))
+    
+    @classmethod
+    def coerce(cls, weather_data):
+        """兼容传入字典的调用方式"""
+        if weather_data is None or isinstance(weather_data, cls):
+            return weather_data
+        return cls.from_dict(weather_data)
+    
+    def to_dict(self):
+        data = {
+            'current': self.current.to_api(),
+            'forecast': [day.to_api() for day in self.forecast],
+            'air_quality': self.air_quality.to_api() if self.air_quality else None
+        }
+        if self.hourly:
+            data['hourly'] = [hour.to_api() for hour in self.hourly]
+        if self.stale_since is not None:
+            data['stale_since'] = self.stale_since
+        if self.yesterday_temp is not None:
+            data['yesterday_temp'] = self.yesterday_temp
+        return data
+    
+    @property
+    def aqi(self):
+        return self.air_quality.aqi if self.air_quality else None
+
+class ResponseCache:
+    """和风天气接口响应缓存
+    
+    按 (接口, 城市) 缓存，每个接口单独设置过期时间，超过 max_entries 时淘汰最久未使用的条目；
+    配置 cache_file 后可持久化到文件，多次命令行运行共享缓存
+    """
+    
+    def __init__(self, ttl=None, max_entries=1024, cache_file=None):
+        self.ttl = dict(DEFAULT_CACHE_TTL, **(ttl or {}))
+        self.max_entries = max_entries
+        self.cache_file = cache_file
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (接口, 城市) -> (过期时间戳, 响应数据)
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # 保证后取的状态后写入文件
+        self._dirty = False
+        if cache_file:
+            self.load()
+    
+    def get(self, endpoint, location):
+        """读取未过期的缓存，不存在或已过期时返回 None"""
+        key = (endpoint, location)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                    self._dirty = True
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+    
+    def set(self, endpoint, location, data):
+        """写入缓存，过期时间按接口的TTL计算"""
+        ttl = self.ttl.get(endpoint, 0)
+        if ttl <= 0:
+            return
+        key = (endpoint, location)
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+    
+    def load(self):
+        """从缓存文件加载未过期的条目"""
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取缓存文件失败: {e}")
+            return
+        
+        now = time.time()
+        with self._lock:
+            for endpoint, location, expires_at, data in stored:
+                if expires_at > now:
+                    self._entries[(endpoint, location)] = (expires_at, data)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def save(self):
+        """有改动时写回缓存文件（先写临时文件再替换，避免写一半损坏）"""
+        if not self.cache_file or not self._dirty:
+            return
+        with self._save_lock:
+            with self._lock:
+                stored = [[endpoint, location, expires_at, data]
+                          for (endpoint, location), (expires_at, data) in self._entries.items()]
+                self._dirty = False
+            try:
+                write_file_atomic(self.cache_file, json.dumps(stored, ensure_ascii=False))
+            except OSError as e:
+                self._dirty = True  # 下次保存时重试
+                logger.warning(f"写入缓存文件失败: {e}")
+
+class SnapshotStore:
+    """每个城市最近一次成功获取的天气（last-known-good），接口不可用时用来渲染稍旧的数据
+    
+    配置 snapshot_file 后持久化到文件，进程重启或下一次命令行运行仍可使用
+    """
+    
+    def __init__(self, snapshot_file=None):
+        self.snapshot_file = snapshot_file
+        self._snapshots = {}  # city_code -> {"fetched_at": 时间戳, "weather": 接口格式的天气字典}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # 保证后取的状态后写入文件
+        self._dirty = False
+        if snapshot_file:
+            self.load()
+    
+    def put(self, city_code, weather_data):
+        """保存城市最新的天气（WeatherReport）"""
+        with self._lock:
+            self._snapshots[city_code] = {'fetched_at': time.time(), 'weather': weather_data.to_dict()}
+            self._dirty = True
+    
+    def get(self, city_code):
+        """读取城市的快照，返回 (获取时间戳, WeatherReport)，没有时返回 (None, None)"""
+        with self._lock:
+            snapshot = self._snapshots.get(city_code)
+        if snapshot is None:
+            return None, None
+        return snapshot['fetched_at'], WeatherReport.from_dict(snapshot['weather'])
+    
+    def load(self):
+        """从快照文件加载"""
+        try:
+            with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                snapshots = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取天气快照失败: {e}")
+            return
+        with self._lock:
+            self._snapshots.update(snapshots)
+    
+    def save(self):
+        """有改动时写回快照文件"""
+        if not self.snapshot_file or not self._dirty:
+            return
+        with self._save_lock:
+            with self._lock:
+                text = json.dumps(self._snapshots, ensure_ascii=False)
+                self._dirty = False
+            try:
+                write_file_atomic(self.snapshot_file, text)
+            except OSError as e:
+                self._dirty = True  # 下次保存时重试
+                logger.warning(f"写入天气快照失败: {e}")
+
+class CircuitOpenError(OSError):
+    """熔断器打开期间直接拒绝请求（与 requests 的异常一样是 OSError 的子类）"""
+
+class CircuitBreaker:
+    """熔断器：连续失败 failure_threshold 次后打开，reset_timeout 秒内的请求直接失败；
+    到时间后只放行一个试探请求（半开），成功则关闭，失败则重新打开
+    """
+    
+    def __init__(self, failure_threshold=3, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+    
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+    
+    def retry_after(self):
+        """距离允许试探请求还有多少秒"""
+        if self.opened_at is None:
+            return 0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+    
+    def allow(self):
+        """是否允许发起请求"""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self._probing = True
+            return True
+    
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self._probing:
+                    logger.warning(f"天气接口连续失败 {self.failures} 次，熔断 {self.reset_timeout} 秒")
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+class TokenBucket:
+    """令牌桶限速器：平均每秒放行 rate 次，最多允许连续突发 capacity 次"""
+    
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = max(float(capacity), 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """取一个令牌，令牌不足时阻塞等待"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+class SMTPSession:
+    """复用的SMTP连接：登录一次连续发送多封邮件
+    
+    服务器断开连接或单个连接发送达到 max_messages 封后自动重新连接
+    """
+    
+    def __init__(self, host, port, user, password, use_starttls=True, max_messages=50, timeout=30,
+                 metrics=None):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.use_starttls = use_starttls
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.server = None
+        self.sent_count = 0
+    
+    def connect(self):
+        """建立连接、启用TLS并登录"""
+        import smtplib
+        self.close()
+        with self.metrics.timer('smtp_connect_seconds', host=self.host):
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            with self.metrics.timer('smtp_login_seconds', host=self.host):
+                if self.use_starttls:
+                    server.starttls()  # 启用TLS加密
+                server.login(self.user, self.password)
+        except Exception:
+            server.close()
+            raise
+        self.server = server
+        self.sent_count = 0
+    
+    def send(self, from_addr, to_addrs, message):
+        """发送一封邮件，连接已断开时重连后重试一次"""
+        import smtplib
+        if self.server is None or (self.max_messages and self.sent_count >= self.max_messages):
+            self.connect()
+        try:
+            with self.metrics.timer('smtp_send_seconds', host=self.host):
+                self.server.sendmail(from_addr, to_addrs, message)
+        except smtplib.SMTPServerDisconnected:
+            logger.info("SMTP连接已断开，重新连接")
+            self.metrics.inc('smtp_reconnects_total', host=self.host)
+            self.connect()
+            with self.metrics.timer('smtp_send_seconds', host=self.host):
+                self.server.sendmail(from_addr, to_addrs, message)
+        self.sent_count += 1
+    
+    def close(self):
+        """退出登录并关闭连接"""
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except Exception:
+            self.server.close()
+        self.server = None
+
+class EncodedMessage:
+    """预先编码好的邮件：HTML正文只做一次 base64 编码，每个收件人只拼接 To 头"""
+    
+    def __init__(self, from_addr, subject, html_content):
+        from email.header import Header
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+        
+        # 创建邮件
+        msg = MIMEMultipart('alternative')
+        
+        # QQ邮箱要求From字段必须是登录邮箱
+        msg['From'] = from_addr
+        msg['Subject'] = Header(subject, 'utf-8')
+        
+        # 添加HTML内容
+        html_part = MIMEText(html_content, 'html', 'utf-8')
+        msg.attach(html_part)
+        
+        # 统一转成 CRLF 换行的字节串，smtplib 发送 bytes 时不再逐封转换；To 头插在 Subject 之前，与原来的头部顺序一致
+        text = re.sub(r'\r\n|\n|\r', '\r\n', msg.as_string())
+        split_at = text.index('\r\nSubject: ') + 2
+        self.head = text[:split_at].encode('ascii')
+        self.tail = text[split_at:].encode('ascii')
+    
+    @classmethod
+    def from_parts(cls, head, tail):
+        """由已编码的头部和正文部分还原（如从发件队列读出）"""
+        message = cls.__new__(cls)
+        message.head = bytes(head)
+        message.tail = bytes(tail)
+        return message
+    
+    def for_recipient(self, email):
+        """生成发给某个收件人的完整邮件"""
+        if email.isascii():
+            to_header = email
+        else:
+            from email.header import Header
+            to_header = Header(email, 'utf-8').encode()
+        return b''.join((self.head, b'To: ', to_header.encode('ascii'), b'\r\n', self.tail))
+
+class RenderCache:
+    """按内容寻址的邮件缓存
+    
+    键为渲染输入（显示的天气内容、日期、提醒语、发件人）的哈希，值为编码好的邮件；
+    同样的天气只渲染和编码一次，总字节数超过 max_bytes 时淘汰最久未使用的条目
+    """
+    
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # 哈希 -> EncodedMessage
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(*parts):
+        """渲染输入的内容哈希"""
+        payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def get(self, key):
+        with self._lock:
+            message = self._entries.get(key)
+            if message is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return message
+    
+    def set(self, key, message):
+        size = len(message.head) + len(message.tail)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                old = self._entries.pop(key)
+                self.size -= len(old.head) + len(old.tail)
+            self._entries[key] = message
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted.head) + len(evicted.tail)
+    
+    def __len__(self):
+        return len(self._entries)
+
+class WeatherHistory:
+    """历史天气观测（SQLite）
+    
+    每次获取到的实况按 (城市, 观测时间) 追加一行，主键即索引（WITHOUT ROWID 表按城市和时间聚簇存储），
+    按城市查一段时间的记录只需一次索引范围扫描；同一观测时间重复写入会被忽略。
+    追加先缓存在内存中，flush 时一个事务批量写入
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._pending = []
+        self._lock = threading.Lock()
+        import sqlite3
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS observations (
+                city_code TEXT NOT NULL,
+                observed_at REAL NOT NULL,
+                temp INTEGER,
+                humidity INTEGER,
+                aqi INTEGER,
+                text TEXT,
+                PRIMARY KEY (city_code, observed_at)
+            ) WITHOUT ROWID
+        ''')
+    
+    def append(self, city_code, weather_data, observed_at=None):
+        """记录一次实况（WeatherReport），observed_at 默认取接口的观测时间"""
+        current = weather_data.current
+        if observed_at is None:
+            observed_at = observation_time(current.obs_time)
+        with self._lock:
+            self._pending.append((city_code, observed_at, current.temp, current.humidity,
+                                  weather_data.aqi, current.text))
+    
+    def flush(self):
+        """批量写入缓存的记录"""
+        with self._lock:
+            if not self._pending:
+                return
+            self.conn.execute('BEGIN')
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO observations (city_code, observed_at, temp, humidity, aqi, text) '
+                'VALUES (?, ?, ?, ?, ?, ?)', self._pending)
+            self.conn.execute('COMMIT')
+            self._pending = []
+    
+    def query(self, city_code, since, until=None):
+        """城市在 [since, until) 时间段内的记录，按时间排序返回 [(观测时间戳, 温度, 湿度, AQI, 天气), ...]"""
+        until = time.time() + 1 if until is None else until
+        with self._lock:
+            return self.conn.execute(
+                'SELECT observed_at, temp, humidity, aqi, text FROM observations '
+                'WHERE city_code = ? AND observed_at >= ? AND observed_at < ? ORDER BY observed_at',
+                (city_code, since, until)).fetchall()
+    
+    def recent(self, city_code, days=7):
+        """城市最近几天的记录"""
+        return self.query(city_code, time.time() - days * 86400)
+    
+    def temp_near(self, city_code, at, tolerance):
+        """离 at 最近（相差不超过 tolerance 秒）的一次观测温度，没有时返回 None"""
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT observed_at, temp FROM ('
+                '  SELECT observed_at, temp FROM observations WHERE city_code = ? AND observed_at <= ? '
+                '  ORDER BY observed_at DESC LIMIT 1) '
+                'UNION ALL SELECT observed_at, temp FROM ('
+                '  SELECT observed_at, temp FROM observations WHERE city_code = ? AND observed_at > ? '
+                '  ORDER BY observed_at LIMIT 1)',
+                (city_code, at, city_code, at)).fetchall()
+        rows = [(abs(observed_at - at), temp) for observed_at, temp in rows
+                if temp is not None and abs(observed_at - at) <= tolerance]
+        return min(rows)[1] if rows else None
+    
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+class MailSpool:
+    """基于 SQLite 的发件队列
+    
+    渲染好的邮件先落盘（同一封邮件正文只存一份），每个收件人一条状态记录；
+    进程中断后重新运行只补发未发送的部分。状态更新每 commit_every 条合并为一次事务提交，
+    一次 fsync 覆盖一批收件人，兼顾持久性和吞吐（崩溃时最多重复发送最后未提交的一批）；
+    超过保留期的发送由 prune 清理，文件大小不会随运行次数无限增长
+    """
+    
+    def __init__(self, path, commit_every=100):
+        self.path = path
+        self.commit_every = commit_every
+        self._updates = []
+        self._lock = threading.Lock()
+        import sqlite3
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=FULL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS bodies (
+                id INTEGER PRIMARY KEY,
+                run_key TEXT NOT NULL,
+                head BLOB NOT NULL,
+                tail BLOB NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                run_key TEXT NOT NULL,
+                recipient TEXT NOT NULL,
+                body_id INTEGER NOT NULL REFERENCES bodies(id),
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated_at REAL NOT NULL,
+                UNIQUE (run_key, recipient)
+            );
+            CREATE INDEX IF NOT EXISTS messages_status ON messages (run_key, status);
+            CREATE INDEX IF NOT EXISTS messages_body ON messages (body_id);
+            CREATE INDEX IF NOT EXISTS messages_updated ON messages (run_key, updated_at);
+        ''')
+    
+    def known_recipients(self, run_key):
+        """本次发送已入队的收件人"""
+        with self._lock:
+            rows = self.conn.execute('SELECT recipient FROM messages WHERE run_key = ?', (run_key,))
+            return {recipient for recipient, in rows}
+    
+    def enqueue(self, run_key, outbox):
+        """在一个事务中写入 [(收件人列表, EncodedMessage), ...]，已入队的收件人忽略
+        
+        返回与 outbox 对应的新入队记录 [[(记录id, 收件人), ...], ...]
+        """
+        now = time.time()
+        queued = []
+        with self._lock:
+            self.conn.execute('BEGIN')
+            try:
+                for emails, message in outbox:
+                    body_id = self.conn.execute(
+                        'INSERT INTO bodies (run_key, head, tail) VALUES (?, ?, ?)',
+                        (run_key, message.head, message.tail)).lastrowid
+                    self.conn.executemany(
+                        'INSERT OR IGNORE INTO messages (run_key, recipient, body_id, updated_at) '
+                        'VALUES (?, ?, ?, ?)',
+                        [(run_key, email, body_id, now) for email in emails])
+                    queued.append(self.conn.execute(
+                        'SELECT id, recipient FROM messages WHERE body_id = ? ORDER BY id', (body_id,)).fetchall())
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return queued
+    
+    def unsent(self, run_key):
+        """未发送成功（待发送或之前失败）的邮件，按正文分组返回 [(EncodedMessage, [(记录id, 收件人), ...]), ...]"""
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT m.id, m.recipient, b.id, b.head, b.tail FROM messages m '
+                'JOIN bodies b ON b.id = m.body_id '
+                "WHERE m.run_key = ? AND m.status != 'sent' ORDER BY b.id, m.id", (run_key,)).fetchall()
+        
+        outbox = OrderedDict()
+        for message_id, recipient, body_id, head, tail in rows:
+            if body_id not in outbox:
+                outbox[body_id] = (EncodedMessage.from_parts(head, tail), [])
+            outbox[body_id][1].append((message_id, recipient))
+        return list(outbox.values())
+    
+    def record(self, message_id, result):
+        """记录投递结果，攒够 commit_every 条后批量提交"""
+        with self._lock:
+            self._updates.append(('sent' if result.success else 'failed', result.attempts, result.error,
+                                  time.time(), message_id))
+            if len(self._updates) >= self.commit_every:
+                self._flush_locked()
+    
+    def flush(self):
+        """提交所有未提交的状态更新"""
+        with self._lock:
+            self._flush_locked()
+    
+    def _flush_locked(self):
+        if not self._updates:
+            return
+        self.conn.execute('BEGIN')
+        self.conn.executemany(
+            'UPDATE messages SET status = ?, attempts = attempts + ?, error = ?, updated_at = ? WHERE id = ?',
+            self._updates)
+        self.conn.execute('COMMIT')
+        self._updates = []
+    
+    def prune(self, max_age):
+        """删除最后一次更新早于 max_age 秒之前的发送（整个 run_key）及不再被引用的邮件正文，返回删除的收件人记录数
+        
+        删除后空出的页面由 SQLite 复用，文件不再继续增长
+        """
+        cutoff = time.time() - max_age
+        with self._lock:
+            self._flush_locked()
+            self.conn.execute('BEGIN')
+            try:
+                expired = [run_key for run_key, in self.conn.execute(
+                    'SELECT run_key FROM messages GROUP BY run_key HAVING MAX(updated_at) < ?', (cutoff,))]
+                deleted = 0
+                for run_key in expired:
+                    deleted += self.conn.execute('DELETE FROM messages WHERE run_key = ?', (run_key,)).rowcount
+                # 包括所有收件人都已入队、一条记录也没写入的正文
+                self.conn.execute('DELETE FROM bodies WHERE NOT EXISTS '
+                                  '(SELECT 1 FROM messages WHERE messages.body_id = bodies.id)')
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return deleted
+    
+    def counts(self, run_key):
+        """本次发送各状态的收件人数"""
+        with self._lock:
+            rows = self.conn.execute(
+                'SELECT status, COUNT(*) FROM messages WHERE run_key = ? GROUP BY status', (run_key,))
+            return dict(rows.fetchall())
+    
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+class SMTPPool:
+    """SMTP连接池：空闲连接在同一批次的多次发送之间复用"""
+    
+    def __init__(self, factory):
+        self.factory = factory
+        self.closed = False
+        self._idle = []
+        self._lock = threading.Lock()
+    
+    def acquire(self):
+        """取出一个空闲连接，没有则新建（首次发送时才真正连接）"""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self.factory()
+    
+    def release(self, session):
+        """归还连接，连接池已关闭时直接断开"""
+        with self._lock:
+            if not self.closed:
+                self._idle.append(session)
+                return
+        session.close()
+    
+    def close(self):
+        """关闭所有空闲连接，之后归还的连接也会直接断开"""
+        with self._lock:
+            self.closed = True
+            idle, self._idle = self._idle, []
+        for session in idle:
+            session.close()
+
+class DeliveryResult:
+    """单个收件人的投递结果"""
+    
+    def __init__(self, email, success=False, attempts=0, error=None):
+        self.email = email
+        self.success = success
+        self.attempts = attempts
+        self.error = error
+    
+    def __repr__(self):
+        status = 'ok' if self.success else f'failed: {self.error}'
+        return f"DeliveryResult({self.email!r}, {status}, attempts={self.attempts})"
+
+def is_transient_smtp_error(error):
+    """判断SMTP错误是否为临时错误（4xx、连接断开、网络异常），临时错误可以重试
+    
+    不支持 STARTTLS、没有可用的认证方式、证书校验失败等配置问题重试也不会成功，视为永久错误
+    """
+    import smtplib
+    import ssl
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return False
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    # smtplib 和 ssl 的异常都是 OSError 的子类，要在通用的网络异常之前排除
+    if isinstance(error, (smtplib.SMTPException, ssl.SSLError)):
+        return False
+    return isinstance(error, (socket.timeout, OSError))
+
+class DeliveryEngine:
+    """并行SMTP投递
+    
+    workers 个工作线程各自从连接池取一个连接发送，所有线程共用同一SMTP服务器的限速器；
+    临时失败放入重试队列，按指数退避（retry_delay * 2^n 秒）重试，最多 max_retries 次
+    """
+    
+    def __init__(self, pool, workers=2, rate_limiter=None, max_retries=3, retry_delay=2.0, metrics=None):
+        self.pool = pool
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.workers = max(int(workers), 1)
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+    
+    def deliver(self, from_addr, to_emails, build_message, on_result=None):
+        """投递给所有收件人，build_message(email) 生成邮件内容，返回与 to_emails 同序的 DeliveryResult 列表
+        
+        on_result(序号, DeliveryResult) 在每个收件人得到最终结果时调用
+        """
+        import smtplib
+        results = [DeliveryResult(email) for email in to_emails]
+        queue = [(0.0, index) for index in range(len(results))]  # (可发送时间, 收件人序号)
+        state = {'pending': len(results)}
+        cond = threading.Condition()
+        
+        def next_job():
+            with cond:
+                while state['pending']:
+                    now = time.monotonic()
+                    if queue and queue[0][0] <= now:
+                        return heapq.heappop(queue)[1]
+                    cond.wait(queue[0][0] - now if queue else None)
+                return None
+        
+        def finish(index, retry_at=None):
+            try:
+                if retry_at is None and on_result is not None:
+                    on_result(index, results[index])
+            except Exception as e:
+                # 回调失败（如写入发件队列出错）不影响投递结果，也不能让其他工作线程一直等待
+                logger.error(f"记录投递结果失败: {results[index].email}: {e}")
+            finally:
+                with cond:
+                    if retry_at is None:
+                        state['pending'] -= 1
+                    else:
+                        heapq.heappush(queue, (retry_at, index))
+                    cond.notify_all()
+        
+        def worker():
+            session = self.pool.acquire()
+            try:
+                while True:
+                    index = next_job()
+                    if index is None:
+                        return
+                    result = results[index]
+                    result.attempts += 1
+                    retry_at = None
+                    try:
+                        if self.rate_limiter is not None:
+                            self.rate_limiter.acquire()
+                        session.send(from_addr, [result.email], build_message(result.email))
+                        result.success = True
+                        result.error = None
+                        logger.info(f"邮件发送成功: {result.email}")
+                        self.metrics.inc('deliveries_total', status='success')
+                    except Exception as e:
+                        # 收件人/发件人/内容被拒时 smtplib 已重置会话，连接可继续使用；其他错误时连接状态未知，重新连接
+                        if not isinstance(e, (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                                              smtplib.SMTPDataError)):
+                            session.close()
+                        result.error = str(e)
+                        if is_transient_smtp_error(e) and result.attempts <= self.max_retries:
+                            delay = self.retry_delay * 2 ** (result.attempts - 1)
+                            logger.warning(f"发送到 {result.email} 临时失败，{delay:g}秒后重试: {e}")
+                            self.metrics.inc('delivery_retries_total')
+                            retry_at = time.monotonic() + delay
+                        else:
+                            logger.error(f"发送到 {result.email} 失败: {e}")
+                            self.metrics.inc('deliveries_total', status='failed')
+                    finish(index, retry_at)
+            finally:
+                self.pool.release(session)
+        
+        threads = [threading.Thread(target=worker, name=f'smtp-worker-{i}')
+                   for i in range(min(self.workers, len(results)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+# AQI等级表：按上界二分查找
+AQI_LEVEL_BOUNDS = [50, 100, 150, 200, 300]
+AQI_LEVELS = [
+    ("优", "#00e400"),
+    ("良", "#ffff00"),
+    ("轻度污染", "#ff7e00"),
+    ("中度污染", "#ff0000"),
+    ("重度污染", "#8f3f97"),
+    ("严重污染", "#7e0023")
+]
+
+# 温度穿衣建议表：温度 <= 上界时使用对应建议
+TEMPERATURE_BOUNDS = [0, 10, 15, 20, 25, 30]
+TEMPERATURE_ADVICE = [
+    ("🧥 建议穿厚羽绒服、棉衣，做好防寒保暖", "🧤 记得戴帽子、手套、围巾"),
+    ("🧥 建议穿厚外套、毛衣或薄羽绒服", "👖 可以穿厚裤子或加绒裤"),
+    ("🧥 建议穿薄外套、卫衣或针织衫", "👕 里面可以穿长袖T恤"),
+    ("👕 建议穿长袖衬衫、薄毛衣或薄外套", "👖 可以穿长裤或薄款休闲裤"),
+    ("👕 建议穿长袖T恤、衬衫或薄外套", "☀️ 温度适宜，注意适当增减衣物"),
+    ("👕 建议穿短袖T恤、衬衫或薄款上衣", "🩳 可以穿短裤、薄款长裤或裙子"),
+    ("👕 建议穿清爽的短袖、薄款衣物", "🌡️ 天气较热，选择透气性好的衣物")
+]
+
+# 天气类别，数值越小优先级越高
+WEATHER_RAIN, WEATHER_SNOW, WEATHER_WIND, WEATHER_SUNNY, WEATHER_FOG = range(5)
+WEATHER_KEYWORD_CATEGORIES = {
+    '雨': WEATHER_RAIN, '雷': WEATHER_RAIN,
+    '雪': WEATHER_SNOW,
+    '风': WEATHER_WIND,
+    '晴': WEATHER_SUNNY, '阳': WEATHER_SUNNY,
+    '雾': WEATHER_FOG, '霾': WEATHER_FOG
+}
+WEATHER_KEYWORD_PATTERN = re.compile('|'.join(WEATHER_KEYWORD_CATEGORIES))
+WEATHER_ADVICE = {
+    WEATHER_RAIN: ("☔ 记得带雨伞，选择防水外套", "👟 建议穿防滑鞋，避免穿容易湿透的鞋子"),
+    WEATHER_SNOW: ("❄️ 雪天路滑，穿防滑保暖的鞋子", "🧥 选择防风防水的外套"),
+    WEATHER_WIND: ("💨 风力较大，选择贴身不易被风吹起的衣物", "🧢 户外活动时注意固定帽子等配饰"),
+    WEATHER_SUNNY: ("☀️ 晴天阳光强，建议做好防晒措施", "🕶️ 可以准备太阳镜和防晒霜"),
+    WEATHER_FOG: ("😷 雾霾天气，建议佩戴口罩", "🚗 能见度低，出行注意安全")
+}
+
+# 降雨关键词（雨、雷阵雨、毛毛雨、暴雨等都包含“雨”或“雷”）
+RAIN_PATTERN = re.compile('[雨雷]')
+
+# AQI出行建议表：AQI <= 上界时使用对应建议
+AQI_ADVICE_BOUNDS = [50, 100, 150]
+AQI_ADVICE = [
+    ("🫁 空气质量优良，适合户外活动",),
+    (),
+    ("😷 空气质量较差，建议佩戴口罩",),
+    ("😷 空气质量较差，建议佩戴口罩", "🏠 空气污染严重，减少户外活动")
+]
+
+# 随机添加的贴心提醒
+DAILY_TIPS = [
+    "💝 和huhu一样无忧无虑",
+    "🌈 每天都要开开心心哒",
+    "💪 今天也要努力！",
+    "🎯 愿你每一天都很美好",
+    "✨ 小麻雀生活愉快"
+]
+
+class CompiledTemplate:
+    """预编译的HTML模板：加载时按 {字段} 切分一次，渲染时只按顺序拼接静态片段和字段值"""
+    
+    FIELD_PATTERN = re.compile(r'\{(\w+)\}')
+    
+    def __init__(self, source):
+        pieces = self.FIELD_PATTERN.split(source)
+        self.first = pieces[0]
+        self.rest = list(zip(pieces[1::2], pieces[2::2]))
+    
+    def render_into(self, parts, values):
+        """渲染结果追加到 parts 列表，最后统一 join"""
+        parts.append(self.first)
+        for field, static in self.rest:
+            parts.append(str(values[field]))
+            parts.append(static)
+
+# 邮件HTML模板（样式、标题、页脚等静态内容只在加载时处理一次）
+WEATHER_HEAD_TEMPLATE = CompiledTemplate("""
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <meta charset="UTF-8">
+            <style>
+                body { font-family: Arial, sans-serif; line-height: 1.6; margin: 20px; }
+                .weather-card { 
+                    background: linear-gradient(135deg, #74b9ff, #0984e3);
+                    color: white; 
+                    padding: 20px; 
+                    border-radius: 10px; 
+                    margin: 10px 0;
+                }
+                .current-weather { 
+                    text-align: center; 
+                    font-size: 1.2em; 
+                }
+                .forecast { 
+                    margin-top: 20px; 
+                    background: #f8f9fa; 
+                    color: #333; 
+                    padding: 15px; 
+                    border-radius: 8px;
+                }
+                .forecast-item { 
+                    padding: 8px; 
+                    border-bottom: 1px solid #e9ecef;
+                }
+                .rain-alert {
+                    background: linear-gradient(135deg, #74b9ff, #0984e3);
+                    color: white;
+                    padding: 15px;
+                    border-radius: 8px;
+                    margin: 15px 0;
+                    border-left: 4px solid #0066cc;
+                    text-align: center;
+                    font-size: 1.1em;
+                }
+                .temperature { font-size: 2em; font-weight: bold; }
+                .date { color: #6c757d; font-size: 0.9em; }
+                .clothing-advice {
+                    background: linear-gradient(135deg, #fd79a8, #e84393);
+                    color: white;
+                    padding: 15px;
+                    border-radius: 8px;
+                    margin: 15px 0;
+                }
+            </style>
+        </head>
+        <body>
+            <h1>小麻雀天气助手</h1>
+            <div class="date">{date_text}</div>
+            
+            <div class="weather-card">
+                <div class="current-weather">
+                    <div class="temperature">{temp}°C</div>
+                    <div style="font-size: 1.1em; margin: 10px 0;">
+                        {text}
+                    </div>
+                    <div style="font-size: 0.9em;">
+                        💨 {wind_dir} {wind_scale}级 | 
+                        💧 湿度 {humidity}% | 
+                        {aqi_info}👁️ 能见度 {vis}km
+                    </div>
+                </div>
+            </div>
+        """)
+
+STALE_NOTICE_TEMPLATE = CompiledTemplate("""
+            <div class="date" style="text-align: center; margin: 10px 0;">
+                ⚠️ 天气服务暂时不可用，以上为 {fetched_at} 获取的天气数据
+            </div>
+            """)
+
+RAIN_ALERT_TEMPLATE = CompiledTemplate("""
+            <div class="rain-alert">
+                {rain_alert}
+            </div>
+            """)
+
+FORECAST_ITEM_TEMPLATE = CompiledTemplate("""
+                <div class="forecast-item">
+                    <strong>{day_label}</strong> ({date_str})
+                    <br>
+                    🌅 白天: {text_day} | 🌙 夜间: {text_night}
+                    <br>
+                    🌡️ {temp_min}°C ~ {temp_max}°C | 
+                    💨 {wind_dir_day} {wind_scale_day}级
+                </div>
+                """)
+
+WEATHER_FOOTER_HTML = """
+            <hr style="margin: 20px 0;">
+            <p style="color: #6c757d; font-size: 0.9em; text-align: center;">
+                本邮件由小麻雀天气助手自动发送 🐦 | 数据来源：和风天气
+            </p>
+        </body>
+        </html>
+        """
+
+WEEKDAY_NAMES = ['一', '二', '三', '四', '五', '六', '日']
+
+def display(value, default='N/A'):
+    """缺失的字段显示为 default"""
+    return default if value is None else value
+
+@lru_cache(maxsize=256)
+def forecast_weekday(date_str):
+    """解析预报日期（YYYY-MM-DD），返回星期几的中文名；同一日期只解析一次"""
+    return WEEKDAY_NAMES[datetime.strptime(date_str, '%Y-%m-%d').weekday()]
+
+def render_weather_html(weather_data, date_text, aqi_info, rain_alert, clothing_advice, stale_notice=None):
+    """用预编译模板渲染天气邮件HTML，输出与逐段拼接字符串的写法完全一致
+    
+    渲染只依赖传入的参数，天气数据相同的城市/收件人可以共用同一次渲染结果
+    """
+    current = weather_data.current
+    parts = []
+    WEATHER_HEAD_TEMPLATE.render_into(parts, {
+        'date_text': date_text,
+        'temp': display(current.temp),
+        'text': display(current.text, '未知'),
+        'wind_dir': display(current.wind_dir),
+        'wind_scale': display(current.wind_scale),
+        'humidity': display(current.humidity),
+        'aqi_info': aqi_info,
+        'vis': display(current.vis)
+    })
+    
+    # 使用快照数据时注明数据时间
+    if stale_notice:
+        STALE_NOTICE_TEMPLATE.render_into(parts, {'fetched_at': stale_notice})
+    
+    # 添加简单的降雨提醒
+    if rain_alert:
+        RAIN_ALERT_TEMPLATE.render_into(parts, {'rain_alert': rain_alert})
+    
+    # 添加预报信息，跳过今天，显示明天、后天和第三天
+    if weather_data.forecast:
+        parts.append('<div class="forecast"><h3>📅 未来几天预报</h3>')
+        for i, day in enumerate(weather_data.forecast[1:4], 1):
+            date_str = day.date or ''
+            day_label = f"第{i+1}天"
+            if date_str:
+                try:
+                    weekday = forecast_weekday(date_str)
+                    if i == 1:
+                        day_label = "明天"
+                    elif i == 2:
+                        day_label = "后天"
+                    else:
+                        day_label = f"周{weekday}"
+                except Exception:
+                    pass
+            FORECAST_ITEM_TEMPLATE.render_into(parts, {
+                'day_label': day_label,
+                'date_str': date_str,
+                'text_day': display(day.text_day),
+                'text_night': display(day.text_night),
+                'temp_min': display(day.temp_min),
+                'temp_max': display(day.temp_max),
+                'wind_dir_day': display(day.wind_dir_day),
+                'wind_scale_day': display(day.wind_scale_day)
+            })
+        parts.append('</div>')
+    
+    # 添加温馨提醒
+    if clothing_advice:
+        parts.append('<div class="clothing-advice"><h3>💝 温馨提醒</h3>')
+        parts.extend(f'<div style="margin: 5px 0;">• {advice}</div>' for advice in clothing_advice)
+        parts.append('</div>')
+    
+    parts.append(WEATHER_FOOTER_HTML)
+    return ''.join(parts)
+
+async def sleep_until(when):
+    """睡眠到指定的带时区时间；长时间等待时分段睡眠，避免系统休眠或调整时钟造成误差"""
+    import asyncio
+    while True:
+        remaining = (when - datetime.now(when.tzinfo)).total_seconds()
+        if remaining <= 0:
+            return
+        await asyncio.sleep(min(remaining, 600))
+
+class MergedDelivery:
+    """把排队中的多组投递合并为一次投递：按收件人找到各自的邮件，投递结果再分派回各组的回调
+    
+    每组单独投递时，每组都要启动发送线程并在最后几封上等待；合并后发送线程持续有活可做
+    """
+    
+    def __init__(self):
+        self.emails = []
+        self._messages = {}  # 收件人 -> EncodedMessage
+        self._starts = []  # 每组第一个收件人的序号
+        self._callbacks = []
+    
+    def add(self, emails, message, on_result=None):
+        """加入一组投递；与已加入的收件人重复时不加入，返回 False"""
+        if any(email in self._messages for email in emails):
+            return False
+        self._starts.append(len(self.emails))
+        self._callbacks.append(on_result)
+        self.emails.extend(emails)
+        for email in emails:
+            self._messages[email] = message
+        return True
+    
+    def for_recipient(self, email):
+        return self._messages[email].for_recipient(email)
+    
+    def on_result(self, index, result):
+        group = bisect_right(self._starts, index) - 1
+        callback = self._callbacks[group]
+        if callback is not None:
+            callback(index - self._starts[group], result)
+
+class StageStats:
+    """流水线中一个阶段的处理量和耗时，用来找出瓶颈阶段"""
+    
+    def __init__(self, name, workers, metrics=None):
+        self.name = name
+        self.workers = workers
+        self.metrics = metrics
+        self.items = 0
+        self.busy = 0.0
+    
+    @contextmanager
+    def track(self, items=1):
+        """统计 with 代码块处理了 items 项和耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.items += items
+            self.busy += elapsed
+            if self.metrics is not None:
+                self.metrics.observe('pipeline_stage_seconds', elapsed, stage=self.name)
+    
+    def summary(self, wall_seconds):
+        """处理量、吞吐（每秒处理项数）和利用率（忙碌时间占 并发数 x 总时长 的比例）"""
+        return {
+            'workers': self.workers,
+            'items': self.items,
+            'busy_seconds': round(self.busy, 3),
+            'per_second': round(self.items / wall_seconds, 2) if wall_seconds else 0,
+            'utilization': round(self.busy / (wall_seconds * self.workers), 3) if wall_seconds else 0
+        }
+
+class RecipientDispatcher:
+    """按收件人维护下一次发送时间的小顶堆
+    
+    每次取出最早到期的时刻，把同一时刻到期的收件人合并为一批，并把他们放回堆中的下一次发送时间；
+    每个收件人只占一个堆节点，调度开销为 O(log n)
+    """
+    
+    def __init__(self, next_time):
+        self.next_time = next_time  # next_time(send_times, now) -> 下一次发送时间
+        self._heap = []  # (UTC时间戳, 序号)
+        self._entries = []  # 序号 -> (收件人, send_times, 时区, 下一次发送时间)
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def add(self, recipient, send_times, timezone, now):
+        """加入一个收件人，now 之后的第一个发送时间入堆"""
+        index = len(self._entries)
+        send_at = self.next_time(send_times, now.astimezone(timezone))
+        self._entries.append((recipient, send_times, timezone, send_at))
+        heapq.heappush(self._heap, (send_at.timestamp(), index))
+    
+    def pop_due_batch(self):
+        """取出最早到期的一批，返回 (发送时间, [收件人, ...])"""
+        due, index = heapq.heappop(self._heap)
+        indexes = [index]
+        while self._heap and self._heap[0][0] == due:
+            indexes.append(heapq.heappop(self._heap)[1])
+        
+        send_at = self._entries[index][3]
+        batch = []
+        for index in indexes:
+            recipient, send_times, timezone, entry_send_at = self._entries[index]
+            batch.append(recipient)
+            next_at = self.next_time(send_times, entry_send_at)
+            self._entries[index] = (recipient, send_times, timezone, next_at)
+            heapq.heappush(self._heap, (next_at.timestamp(), index))
+        return send_at, batch
+
 class WeatherEmail:
-    def __init__(self, config_file='email_config.json'):
-        """初始化天气邮件服务"""
-        self.config = self.load_config(config_file)
+    def __init__(self, config_file='email_config.json', config=None):
+        """初始化天气邮件服务，传入 config 时不再读取配置文件"""
+        self.config = config if config is not None else self.load_config(config_file)
+        self._lock = threading.Lock()
+        self._session = None
+        self._executor = None
+        self._smtp_pool = None
+        self._smtp_batch_depth = 0
+        self._rate_limiters = {}
+        self.metrics = Metrics()
+        self._spool = None
+        self.render_cache = RenderCache(self.config.get('render_cache_max_bytes', 32 * 1024 * 1024))
+        self._inflight = {}  # (接口, 城市) -> 进行中的请求 Future
+        self._breakers = {}
+        self._revalidating = set()
+        self.snapshots = SnapshotStore(self.config.get('snapshot_file'))
+        self.history = WeatherHistory(self.config['history_file']) if self.config.get('history_file') else None
+        self.cache = None
+        if self.config.get('cache_enabled', True):
+            self.cache = ResponseCache(ttl=self.config.get('cache_ttl'),
+                                       max_entries=self.config.get('cache_max_entries', 1024),
+                                       cache_file=self.config.get('cache_file'))
         
     def load_config(self, config_file):
         """加载配置文件"""
@@ -33,6 +1505,191 @@ class WeatherEmail:
             logger.error(f"配置文件 {config_file} 不存在")
             return {}
     
+    def get_session(self):
+        """获取复用的HTTP会话（keep-alive连接池，线程间共享）"""
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+                    pool_size = self.config.get('http_pool_size', self.config.get('fetch_workers', 16))
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                            pool_maxsize=pool_size)
+                    session = requests.Session()
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+        return self._session
+    
+    def get_executor(self):
+        """获取请求天气接口用的线程池"""
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.config.get('fetch_workers', 16),
+                        thread_name_prefix='weather-fetch')
+        return self._executor
+    
+    def close(self):
+        """释放线程池、HTTP连接、发件队列和历史记录"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        if self.history is not None:
+            self.history.close()
+            self.history = None
+    
+    def get_timeout(self, endpoint):
+        """获取单个接口的超时时间，可通过 weather_timeouts 按接口单独配置"""
+        timeouts = self.config.get('weather_timeouts', {})
+        return timeouts.get(endpoint, self.config.get('weather_timeout', 10))
+    
+    def get_breaker(self, api_host):
+        """获取接口主机对应的熔断器"""
+        with self._lock:
+            if api_host not in self._breakers:
+                self._breakers[api_host] = CircuitBreaker(
+                    failure_threshold=self.config.get('circuit_failure_threshold', 3),
+                    reset_timeout=self.config.get('circuit_reset_timeout', 60))
+            return self._breakers[api_host]
+    
+    def fetch_endpoint(self, endpoint, city_code):
+        """请求单个和风天气接口（如 weather/now），返回解析后的JSON"""
+        api_host = self.config.get('weather_api_host', 'devapi.qweather.com')
+        scheme = self.config.get('weather_api_scheme', 'https')
+        url = f"{scheme}://{api_host}/v7/{endpoint}"
+        params = {
+            'location': city_code,
+            'key': self.config.get('weather_api_key')
+        }
+        # 同一接口主机连续失败后熔断，直接失败而不再等待超时
+        breaker = self.get_breaker(api_host)
+        if not breaker.allow():
+            self.metrics.inc('weather_api_calls_total', endpoint=endpoint, status='circuit_open')
+            raise CircuitOpenError(f"{api_host} 熔断中，{breaker.retry_after():.0f}秒后重试")
+        
+        try:
+            with self.metrics.timer('weather_api_request_seconds', endpoint=endpoint):
+                response = self.get_session().get(url, params=params, timeout=self.get_timeout(endpoint))
+                response.raise_for_status()
+                data = response.json()
+        except Exception:
+            breaker.record_failure()
+            self.metrics.inc('weather_api_calls_total', endpoint=endpoint, status='error')
+            raise
+        breaker.record_success()
+        self.metrics.inc('weather_api_calls_total', endpoint=endpoint,
+                         status='ok' if data.get('code') == '200' else 'api_error')
+        
+        # 只缓存成功的响应
+        if self.cache is not None and data.get('code') == '200':
+            self.cache.set(endpoint, city_code, data)
+        return data
+    
+    def get_forecast_endpoint(self):
+        """逐天预报接口，forecast_days 可配置为 3 或 7 天"""
+        return f"weather/{self.config.get('forecast_days', 3)}d"
+    
+    def get_endpoints(self):
+        """每个城市需要请求的接口：实况、逐天预报、空气质量，开启 hourly_forecast 时加上逐小时预报"""
+        endpoints = ('weather/now', self.get_forecast_endpoint(), 'air/now')
+        if self.config.get('hourly_forecast'):
+            endpoints += ('weather/24h',)
+        return endpoints
+    
+    def submit_weather(self, city_code):
+        """并发提交实况、逐天预报和空气质量等请求，返回 {接口: Future}
+        
+        命中缓存的接口直接返回已完成的 Future，正在请求中的接口共用同一个 Future，不再请求网络
+        """
+        executor = self.get_executor()
+        futures = {}
+        for endpoint in self.get_endpoints():
+            cached = self.cache.get(endpoint, city_code) if self.cache is not None else None
+            if self.cache is not None:
+                self.metrics.inc('weather_cache_requests_total', endpoint=endpoint,
+                                 result='miss' if cached is None else 'hit')
+            if cached is not None:
+                futures[endpoint] = Future()
+                futures[endpoint].set_result(cached)
+            else:
+                futures[endpoint] = self.fetch_shared(executor, endpoint, city_code)
+        return futures
+    
+    def fetch_shared(self, executor, endpoint, city_code):
+        """合并并发请求：同一 (接口, 城市) 已有请求在进行时，直接共用它的 Future，不再重复请求"""
+        key = (endpoint, city_code)
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.metrics.inc('weather_requests_coalesced_total', endpoint=endpoint)
+                return future
+            future = executor.submit(self.fetch_endpoint, endpoint, city_code)
+            self._inflight[key] = future
+        
+        def forget(done):
+            with self._lock:
+                if self._inflight.get(key) is done:
+                    del self._inflight[key]
+        
+        future.add_done_callback(forget)
+        return future
+    
+    def collect_weather(self, futures):
+        """等待并汇总各接口的结果，解析为 WeatherReport；预报和空气质量失败时返回部分结果"""
+        try:
+            data = futures['weather/now'].result()
+        except (OSError, ValueError) as e:  # requests 的异常都是 OSError 的子类
+            logger.error(f"请求天气API失败: {e}")
+            return None
+        
+        if data.get('code') != '200':
+            logger.error(f"获取天气失败: {data.get('code')}")
+            return None
+        
+        # 获取逐天预报
+        forecast = []
+        try:
+            forecast_data = futures[self.get_forecast_endpoint()].result()
+            if forecast_data.get('code') == '200':
+                forecast = [DailyForecast.from_api(day) for day in forecast_data.get('daily', [])]
+            else:
+                logger.warning(f"获取天气预报失败: {forecast_data.get('code')}")
+        except Exception as e:
+            logger.warning(f"获取天气预报异常: {e}")
+        
+        # 获取逐小时预报
+        hourly = []
+        if 'weather/24h' in futures:
+            try:
+                hourly_data = futures['weather/24h'].result()
+                if hourly_data.get('code') == '200':
+                    hourly = [HourlyForecast.from_api(hour) for hour in hourly_data.get('hourly', [])]
+                else:
+                    logger.warning(f"获取逐小时预报失败: {hourly_data.get('code')}")
+            except Exception as e:
+                logger.warning(f"获取逐小时预报异常: {e}")
+        
+        # 获取空气质量数据
+        air_quality = None
+        try:
+            air_data = futures['air/now'].result()
+            if air_data.get('code') == '200':
+                air_quality = AirQuality.from_api(air_data.get('now', {}))
+                logger.info("空气质量数据获取成功")
+            else:
+                logger.warning(f"获取空气质量失败: {air_data.get('code')}")
+        except Exception as e:
+            logger.warning(f"获取空气质量异常: {e}")
+        
+        return WeatherReport(CurrentWeather.from_api(data['now']), forecast, hourly, air_quality)
+    
     def get_weather(self, city_code=None):
         """获取天气信息"""
         city_code = city_code or self.config.get('city_code', '101010100')  # 默认北京
@@ -41,133 +1698,151 @@ class WeatherEmail:
         if not weather_key:
             logger.error("未配置天气API密钥")
             return None
-            
-        # 使用和风天气API
-        api_host = self.config.get('weather_api_host', 'devapi.qweather.com')
-        url = f"https://{api_host}/v7/weather/now"
-        params = {
-            'location': city_code,
-            'key': weather_key
-        }
         
-        try:
-            response = requests.get(url, params=params, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-            
-            if data.get('code') == '200':
-                weather_info = data['now']
-                
-                # 获取未来3天预报
-                forecast_url = f"https://{api_host}/v7/weather/3d"
-                forecast_response = requests.get(forecast_url, params=params, timeout=10)
-                forecast_data = forecast_response.json()
-                
-                # 获取空气质量数据
-                air_quality = None
-                try:
-                    air_url = f"https://{api_host}/v7/air/now"
-                    air_response = requests.get(air_url, params=params, timeout=10)
-                    air_data = air_response.json()
-                    if air_data.get('code') == '200':
-                        air_quality = air_data.get('now', {})
-                        logger.info("空气质量数据获取成功")
-                    else:
-                        logger.warning(f"获取空气质量失败: {air_data.get('code')}")
-                except Exception as e:
-                    logger.warning(f"获取空气质量异常: {e}")
-                
-                return {
-                    'current': weather_info,
-                    'forecast': forecast_data.get('daily', [])[:3] if forecast_data.get('code') == '200' else [],
-                    'air_quality': air_quality
-                }
-            else:
-                logger.error(f"获取天气失败: {data.get('code')}")
-                return None
-                
-        except requests.RequestException as e:
-            logger.error(f"请求天气API失败: {e}")
+        # 使用和风天气API，三个接口通过连接池并发请求
+        weather_data = self.resolve_weather(city_code, self.submit_weather(city_code))
+        self.save_state()
+        return weather_data
+    
+    def resolve_weather(self, city_code, futures):
+        """汇总接口结果：成功时更新快照，失败时退回到最近一次成功的快照"""
+        weather_data = self.collect_weather(futures)
+        if weather_data:
+            self.record_history(city_code, weather_data)
+            # 只有带预报的完整结果才作为快照
+            if weather_data.forecast:
+                self.snapshots.put(city_code, weather_data)
+            return weather_data
+        return self.get_stale_weather(city_code)
+    
+    def record_history(self, city_code, weather_data):
+        """配置 history_file 时记录本次实况，并查出昨天同一时间的温度用于对比"""
+        if self.history is None:
+            return
+        observed_at = observation_time(weather_data.current.obs_time)
+        tolerance = self.config.get('history_tolerance_hours', 3) * 3600
+        weather_data.yesterday_temp = self.history.temp_near(city_code, observed_at - 86400, tolerance)
+        self.history.append(city_code, weather_data, observed_at)
+    
+    def get_stale_weather(self, city_code):
+        """读取城市的快照作为降级数据（标记 stale_since），并安排后台刷新"""
+        fetched_at, weather_data = self.snapshots.get(city_code)
+        max_age = self.config.get('stale_max_age_hours', 48) * 3600
+        if weather_data is None or time.time() - fetched_at > max_age:
             return None
+        
+        self.schedule_revalidation(city_code)
+        fetched = datetime.fromtimestamp(fetched_at)
+        logger.warning(f"天气接口不可用，使用 {fetched.strftime('%m-%d %H:%M')} 的天气快照: {city_code}")
+        self.metrics.inc('stale_weather_served_total')
+        
+        # 去掉已经过去的预报日期和小时，保证 forecast[0] 仍是今天
+        now = datetime.now().astimezone()
+        today = now.strftime('%Y-%m-%d')
+        weather_data.forecast = [day for day in weather_data.forecast if (day.date or today) >= today]
+        weather_data.hourly = [hour for hour in weather_data.hourly if not hour_has_passed(hour.time, now)]
+        weather_data.stale_since = fetched_at
+        return weather_data
+    
+    def schedule_revalidation(self, city_code):
+        """后台定时重新获取城市天气，成功后刷新快照；同一城市同时只有一个刷新任务"""
+        with self._lock:
+            if city_code in self._revalidating:
+                return
+            self._revalidating.add(city_code)
+        
+        api_host = self.config.get('weather_api_host', 'devapi.qweather.com')
+        delay = max(self.get_breaker(api_host).retry_after(), self.config.get('revalidate_interval', 300))
+        
+        def revalidate():
+            with self._lock:
+                self._revalidating.discard(city_code)
+            weather_data = self.collect_weather(self.submit_weather(city_code))
+            if not weather_data or not weather_data.forecast:
+                self.schedule_revalidation(city_code)
+                return
+            logger.info(f"天气快照已刷新: {city_code}")
+            self.record_history(city_code, weather_data)
+            self.snapshots.put(city_code, weather_data)
+            self.save_state()
+        
+        timer = threading.Timer(delay, revalidate)
+        timer.daemon = True
+        timer.start()
+    
+    def save_state(self):
+        """持久化响应缓存、天气快照和历史记录"""
+        if self.cache is not None:
+            self.cache.save()
+        self.snapshots.save()
+        if self.history is not None:
+            self.history.flush()
     
     def get_aqi_level(self, aqi_value):
         """根据AQI值获取等级描述"""
         if aqi_value is None:
             return "未知", "#999999"
         
-        aqi = int(aqi_value)
-        if aqi <= 50:
-            return "优", "#00e400"
-        elif aqi <= 100:
-            return "良", "#ffff00"
-        elif aqi <= 150:
-            return "轻度污染", "#ff7e00"
-        elif aqi <= 200:
-            return "中度污染", "#ff0000"
-        elif aqi <= 300:
-            return "重度污染", "#8f3f97"
-        else:
-            return "严重污染", "#7e0023"
+        return AQI_LEVELS[bisect_left(AQI_LEVEL_BOUNDS, int(aqi_value))]
     
-    def get_clothing_advice(self, weather_data):
+    def get_clothing_advice(self, weather_data, tip=None):
         """根据天气生成智能穿衣建议"""
-        if not weather_data:
-            return ["天气信息不可用，请根据实际情况穿衣"]
+        with self.metrics.timer('clothing_advice_seconds'):
+            return self.get_clothing_advice_batch([weather_data], tip)[0]
+    
+    def get_clothing_advice_batch(self, weather_list, tip=None):
+        """批量生成穿衣建议，日期相关的提醒整批只计算一次
+        
+        tip 为本次发送固定的贴心提醒，不指定时每条随机选择
+        """
+        beijing_now = datetime.utcnow() + timedelta(hours=8)
+        first_of_month = beijing_now.day == 1
+        
+        advice_batch = []
+        for weather_data in weather_list:
+            if not weather_data:
+                advice_batch.append(["天气信息不可用，请根据实际情况穿衣"])
+                continue
+            
+            advice_list = self.match_advice_rules(WeatherReport.coerce(weather_data))
+            
+            # 随机添加一些贴心提醒
+            if first_of_month:
+                advice_list.append(f"{beijing_now.month}月快乐！黄雨珏同学！")
+            else:
+                advice_list.append(tip if tip is not None else random.choice(DAILY_TIPS))
+            advice_batch.append(advice_list)
         
-        current = weather_data['current']
-        temp = int(current.get('temp', 20))  # 当前温度
-        weather_text = current.get('text', '').lower()  # 天气状况
-        humidity = int(current.get('humidity', 50))  # 湿度
-        wind_scale = current.get('windScale', '0')  # 风力等级
+        return advice_batch
+    
+    def match_advice_rules(self, weather_data):
+        """按规则表匹配温度、天气、湿度、温差和空气质量建议（weather_data 为 WeatherReport）"""
+        current = weather_data.current
+        temp = display(current.temp, 20)  # 当前温度
+        weather_text = current.text or ''  # 天气状况
+        humidity = display(current.humidity, 50)  # 湿度
+        wind_scale = display(current.wind_scale, 0)  # 风力等级
         
         # 获取明日温度范围（如果有预报）
         tomorrow_min = tomorrow_max = None
-        if weather_data['forecast']:
-            tomorrow = weather_data['forecast'][0]
-            tomorrow_min = int(tomorrow.get('tempMin', temp))
-            tomorrow_max = int(tomorrow.get('tempMax', temp))
-        
-        advice_list = []
+        if weather_data.forecast:
+            tomorrow = weather_data.forecast[0]
+            tomorrow_min = display(tomorrow.temp_min, temp)
+            tomorrow_max = display(tomorrow.temp_max, temp)
         
         # 基础温度建议
-        if temp <= 0:
-            advice_list.append("🧥 建议穿厚羽绒服、棉衣，做好防寒保暖")
-            advice_list.append("🧤 记得戴帽子、手套、围巾")
-        elif temp <= 10:
-            advice_list.append("🧥 建议穿厚外套、毛衣或薄羽绒服")
-            advice_list.append("👖 可以穿厚裤子或加绒裤")
-        elif temp <= 15:
-            advice_list.append("🧥 建议穿薄外套、卫衣或针织衫")
-            advice_list.append("👕 里面可以穿长袖T恤")
-        elif temp <= 20:
-            advice_list.append("👕 建议穿长袖衬衫、薄毛衣或薄外套")
-            advice_list.append("👖 可以穿长裤或薄款休闲裤")
-        elif temp <= 25:
-            advice_list.append("👕 建议穿长袖T恤、衬衫或薄外套")
-            advice_list.append("☀️ 温度适宜，注意适当增减衣物")
-        elif temp <= 30:
-            advice_list.append("👕 建议穿短袖T恤、衬衫或薄款上衣")
-            advice_list.append("🩳 可以穿短裤、薄款长裤或裙子")
-        else:
-            advice_list.append("👕 建议穿清爽的短袖、薄款衣物")
-            advice_list.append("🌡️ 天气较热，选择透气性好的衣物")
-        
-        # 特殊天气建议
-        if '雨' in weather_text or '雷' in weather_text:
-            advice_list.append("☔ 记得带雨伞，选择防水外套")
-            advice_list.append("👟 建议穿防滑鞋，避免穿容易湿透的鞋子")
-        elif '雪' in weather_text:
-            advice_list.append("❄️ 雪天路滑，穿防滑保暖的鞋子")
-            advice_list.append("🧥 选择防风防水的外套")
-        elif '风' in weather_text or int(wind_scale) >= 4:
-            advice_list.append("💨 风力较大，选择贴身不易被风吹起的衣物")
-            advice_list.append("🧢 户外活动时注意固定帽子等配饰")
-        elif '晴' in weather_text or '阳' in weather_text:
-            advice_list.append("☀️ 晴天阳光强，建议做好防晒措施")
-            advice_list.append("🕶️ 可以准备太阳镜和防晒霜")
-        elif '雾' in weather_text or '霾' in weather_text:
-            advice_list.append("😷 雾霾天气，建议佩戴口罩")
-            advice_list.append("🚗 能见度低，出行注意安全")
+        advice_list = list(TEMPERATURE_ADVICE[bisect_left(TEMPERATURE_BOUNDS, temp)])
+        
+        # 特殊天气建议：一次扫描找出优先级最高的天气类别（雨 > 雪 > 风 > 晴 > 雾霾）
+        category = min((WEATHER_KEYWORD_CATEGORIES[keyword]
+                        for keyword in WEATHER_KEYWORD_PATTERN.findall(weather_text)),
+                       default=None)
+        if category in (WEATHER_RAIN, WEATHER_SNOW):
+            advice_list.extend(WEATHER_ADVICE[category])
+        elif category == WEATHER_WIND or wind_scale >= 4:
+            advice_list.extend(WEATHER_ADVICE[WEATHER_WIND])
+        elif category is not None:
+            advice_list.extend(WEATHER_ADVICE[category])
         
         # 湿度建议
         if humidity >= 80:
@@ -183,330 +1858,742 @@ class WeatherEmail:
             elif abs(temp - tomorrow_min) >= 10 or abs(temp - tomorrow_max) >= 10:
                 advice_list.append("📈 气温变化较大，建议准备备用衣物")
         
+        # 与昨天同一时间对比（需要配置 history_file）
+        if weather_data.yesterday_temp is not None and current.temp is not None:
+            change = current.temp - weather_data.yesterday_temp
+            if change <= -self.config.get('temp_change_threshold', 3):
+                advice_list.append(f"🥶 比昨天同一时间冷{-change}°C，注意添衣")
+            elif change >= self.config.get('temp_change_threshold', 3):
+                advice_list.append(f"🥵 比昨天同一时间热{change}°C，注意适当减衣")
+        
         # AQI空气质量建议
-        if weather_data.get('air_quality'):
-            aqi_value = weather_data['air_quality'].get('aqi')
-            if aqi_value:
-                aqi = int(aqi_value)
-                if aqi > 100:
-                    advice_list.append("😷 空气质量较差，建议佩戴口罩")
-                if aqi > 150:
-                    advice_list.append("🏠 空气污染严重，减少户外活动")
-                elif aqi <= 50:
-                    advice_list.append("🫁 空气质量优良，适合户外活动")
-        
-        # 随机添加一些贴心提醒
-        tips = [
-            "💝 和huhu一样无忧无虑",
-            "🌈 每天都要开开心心哒",
-            "💪 今天也要努力！",
-            "🎯 愿你每一天都很美好",
-            "✨ 小麻雀生活愉快"
-        ]
-        from datetime import datetime, timedelta
-        beijing_now = datetime.utcnow() + timedelta(hours=8)
-        if beijing_now.day == 1:
-            advice_list.append(f"{beijing_now.month}月快乐！黄雨珏同学！")
-        else:
-            advice_list.append(random.choice(tips))
-            
+        aqi_value = weather_data.aqi
+        if aqi_value is not None:
+            advice_list.extend(AQI_ADVICE[bisect_left(AQI_ADVICE_BOUNDS, aqi_value)])
+        
         return advice_list
     
     def check_rain_alert(self, weather_data):
-        """检查今天是否可能下雨"""
-        if not weather_data or not weather_data['forecast']:
+        """检查今天是否可能下雨：有逐小时预报时按小时判断，否则按当天白天/夜间的天气描述"""
+        weather_data = WeatherReport.coerce(weather_data)
+        if not weather_data or not weather_data.forecast:
             return None
         
         # 检查当前天气是否有雨
-        current = weather_data['current']
-        current_text = current.get('text', '').lower()
-        if any(keyword in current_text for keyword in ['雨', '雷', '阵雨', '毛毛雨', '小雨', '中雨', '大雨', '暴雨']):
+        if RAIN_PATTERN.search(weather_data.current.text or ''):
             return "☔ 当前正在下雨，出门记得带伞！"
         
-        # 检查今天是否可能下雨
-        if weather_data['forecast']:
-            today = weather_data['forecast'][0]
-            day_text = today.get('textDay', '').lower()
-            night_text = today.get('textNight', '').lower()
-            
-            # 检查今天白天或夜间是否有雨
-            if (any(keyword in day_text for keyword in ['雨', '雷', '阵雨', '毛毛雨', '小雨', '中雨', '大雨', '暴雨']) or
-                any(keyword in night_text for keyword in ['雨', '雷', '阵雨', '毛毛雨', '小雨', '中雨', '大雨', '暴雨'])):
-                return "🌧️ 今天可能有雨，建议携带雨具"
+        # 逐小时预报：找出最近一个可能下雨的小时
+        if weather_data.hourly:
+            hours = weather_data.hourly[:self.config.get('rain_alert_hours', 24)]
+            pop_threshold = self.config.get('rain_pop_threshold', 50)
+            rainy = next((hour for hour in hours if hour.is_rainy(pop_threshold)), None)
+            if rainy is None:
+                return None
+            at = (rainy.time or '')[11:16] or '稍后'
+            if rainy.pop is not None:
+                return f"🌂 预计{at}前后有雨（降水概率{rainy.pop}%），出门记得带伞！"
+            return f"🌂 预计{at}前后有雨，出门记得带伞！"
+        
+        # 检查今天白天或夜间是否有雨
+        today = weather_data.forecast[0]
+        if RAIN_PATTERN.search(today.text_day or '') or RAIN_PATTERN.search(today.text_night or ''):
+            return "🌧️ 今天可能有雨，建议携带雨具"
         
         return None
     
-    def format_weather_html(self, weather_data):
+    def format_weather_html(self, weather_data, tip=None, date_text=None):
         """格式化天气信息为HTML邮件内容"""
         if not weather_data:
             return "<p>获取天气信息失败</p>"
-            
-        current = weather_data['current']
-        
+        weather_data = WeatherReport.coerce(weather_data)
+        render_inputs = self.get_render_inputs(weather_data, tip, date_text)
+        with self.metrics.timer('render_seconds'):
+            return render_weather_html(weather_data, *render_inputs)
+    
+    def get_render_inputs(self, weather_data, tip=None, date_text=None):
+        """除实况和预报字段外，邮件内容依赖的全部参数：(日期, AQI信息, 降雨提醒, 温馨提醒, 快照时间)"""
         # 检查雨天信息
         rain_alert = self.check_rain_alert(weather_data)
         
         # 获取AQI信息
         aqi_info = ""
-        if weather_data.get('air_quality'):
-            aqi_value = weather_data['air_quality'].get('aqi')
-            if aqi_value:
-                aqi_level, aqi_color = self.get_aqi_level(aqi_value)
-                aqi_info = f'🫁 AQI {aqi_value} ({aqi_level}) | '
+        aqi_value = weather_data.aqi
+        if aqi_value is not None:
+            aqi_level, aqi_color = self.get_aqi_level(aqi_value)
+            aqi_info = f'🫁 AQI {aqi_value} ({aqi_level}) | '
         
-        html = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8">
-            <style>
-                body {{ font-family: Arial, sans-serif; line-height: 1.6; margin: 20px; }}
-                .weather-card {{ 
-                    background: linear-gradient(135deg, #74b9ff, #0984e3);
-                    color: white; 
-                    padding: 20px; 
-                    border-radius: 10px; 
-                    margin: 10px 0;
-                }}
-                .current-weather {{ 
-                    text-align: center; 
-                    font-size: 1.2em; 
-                }}
-                .forecast {{ 
-                    margin-top: 20px; 
-                    background: #f8f9fa; 
-                    color: #333; 
-                    padding: 15px; 
-                    border-radius: 8px;
-                }}
-                .forecast-item {{ 
-                    padding: 8px; 
-                    border-bottom: 1px solid #e9ecef;
-                }}
-                .rain-alert {{
-                    background: linear-gradient(135deg, #74b9ff, #0984e3);
-                    color: white;
-                    padding: 15px;
-                    border-radius: 8px;
-                    margin: 15px 0;
-                    border-left: 4px solid #0066cc;
-                    text-align: center;
-                    font-size: 1.1em;
-                }}
-                .temperature {{ font-size: 2em; font-weight: bold; }}
-                .date {{ color: #6c757d; font-size: 0.9em; }}
-                .clothing-advice {{
-                    background: linear-gradient(135deg, #fd79a8, #e84393);
-                    color: white;
-                    padding: 15px;
-                    border-radius: 8px;
-                    margin: 15px 0;
-                }}
-            </style>
-        </head>
-        <body>
-            <h1>小麻雀天气助手</h1>
-            <div class="date">{datetime.now().strftime('%Y年%m月%d日 %A')}</div>
-            
-            <div class="weather-card">
-                <div class="current-weather">
-                    <div class="temperature">{current.get('temp', 'N/A')}°C</div>
-                    <div style="font-size: 1.1em; margin: 10px 0;">
-                        {current.get('text', '未知')}
-                    </div>
-                    <div style="font-size: 0.9em;">
-                        💨 {current.get('windDir', 'N/A')} {current.get('windScale', 'N/A')}级 | 
-                        💧 湿度 {current.get('humidity', 'N/A')}% | 
-                        {aqi_info}👁️ 能见度 {current.get('vis', 'N/A')}km
-                    </div>
-                </div>
-            </div>
-        """
+        date_text = date_text or datetime.now().strftime('%Y年%m月%d日 %A')
         
-        # 添加简单的降雨提醒
-        if rain_alert:
-            html += f'''
-            <div class="rain-alert">
-                {rain_alert}
-            </div>
-            '''
+        # 温馨提醒
+        clothing_advice = self.get_clothing_advice(weather_data, tip)
         
-        # 添加预报信息
-        if weather_data['forecast']:
-            html += '<div class="forecast"><h3>📅 未来几天预报</h3>'
-            weekdays = ['一', '二', '三', '四', '五', '六', '日']
-            
-            # 跳过今天，显示明天、后天和第三天
-            for i, day in enumerate(weather_data['forecast'][1:], 1):  # 从索引1开始，跳过今天
-                date_str = day.get('fxDate', '')
-                if date_str:
-                    try:
-                        date_obj = datetime.strptime(date_str, '%Y-%m-%d')
-                        weekday = weekdays[date_obj.weekday()]
-                        if i == 1:
-                            day_label = "明天"
-                        elif i == 2:
-                            day_label = "后天"
-                        elif i == 3:
-                            day_label = f"周{weekday}"
-                        else:
-                            day_label = f"周{weekday}"
-                    except:
-                        day_label = f"第{i+1}天"
-                else:
-                    day_label = f"第{i+1}天"
-                    
-                html += f'''
-                <div class="forecast-item">
-                    <strong>{day_label}</strong> ({date_str})
-                    <br>
-                    🌅 白天: {day.get('textDay', 'N/A')} | 🌙 夜间: {day.get('textNight', 'N/A')}
-                    <br>
-                    🌡️ {day.get('tempMin', 'N/A')}°C ~ {day.get('tempMax', 'N/A')}°C | 
-                    💨 {day.get('windDirDay', 'N/A')} {day.get('windScaleDay', 'N/A')}级
-                </div>
-                '''
-                # 显示三天：明天、后天和第三天
-                if i >= 3:
-                    break
-            
-            html += '</div>'
-        
-        # 添加温馨提醒
-        clothing_advice = self.get_clothing_advice(weather_data)
-        if clothing_advice:
-            html += '<div class="clothing-advice">'
-            html += '<h3>💝 温馨提醒</h3>'
-            for advice in clothing_advice:
-                html += f'<div style="margin: 5px 0;">• {advice}</div>'
-            html += '</div>'
-        
-        html += '''
-            <hr style="margin: 20px 0;">
-            <p style="color: #6c757d; font-size: 0.9em; text-align: center;">
-                本邮件由小麻雀天气助手自动发送 🐦 | 数据来源：和风天气
-            </p>
-        </body>
-        </html>
-        '''
+        # 接口不可用时使用的快照数据
+        stale_notice = None
+        if weather_data.stale_since:
+            stale_notice = datetime.fromtimestamp(weather_data.stale_since).strftime('%m月%d日 %H:%M')
+        
+        return date_text, aqi_info, rain_alert, clothing_advice, stale_notice
+    
+    @contextmanager
+    def smtp_batch(self):
+        """批量发送期间复用SMTP连接池，最外层结束时断开所有连接"""
+        with self._lock:
+            self._smtp_batch_depth += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._smtp_batch_depth -= 1
+                pool = None
+                if self._smtp_batch_depth == 0:
+                    pool, self._smtp_pool = self._smtp_pool, None
+            if pool is not None:
+                pool.close()
+    
+    def create_smtp_session(self):
+        """按配置创建一个SMTP连接（首次发送时才真正连接）"""
+        return SMTPSession(
+            self.config.get('smtp_server'),
+            self.config.get('smtp_port', 587),
+            self.config.get('email_user'),
+            self.config.get('email_password'),
+            use_starttls=self.config.get('smtp_starttls', True),
+            max_messages=self.config.get('smtp_max_messages_per_session', 50),
+            timeout=self.config.get('smtp_timeout', 30),
+            metrics=self.metrics)
+    
+    def get_smtp_pool(self):
+        """获取当前批次复用的SMTP连接池"""
+        with self._lock:
+            if self._smtp_pool is None:
+                self._smtp_pool = SMTPPool(self.create_smtp_session)
+            return self._smtp_pool
+    
+    def get_rate_limiter(self, smtp_server):
+        """获取SMTP服务器对应的限速器，同一服务器的所有发送线程共用
         
-        return html
+        smtp_rate_limits 可按服务器配置，如 {"smtp.qq.com": 1, "smtp.gmail.com": {"rate": 5, "burst": 10}}，
+        未配置的服务器使用 smtp_rate_limit / smtp_burst（默认每秒1封，0表示不限速）
+        """
+        if smtp_server not in self._rate_limiters:
+            limit = self.config.get('smtp_rate_limits', {}).get(
+                smtp_server, self.config.get('smtp_rate_limit', 1))
+            if not isinstance(limit, dict):
+                limit = {'rate': limit, 'burst': self.config.get('smtp_burst', 5)}
+            self._rate_limiters[smtp_server] = (
+                TokenBucket(limit['rate'], limit.get('burst', 1)) if limit.get('rate') else None)
+        return self._rate_limiters[smtp_server]
     
     def send_email(self, to_emails, subject, html_content):
-        """发送邮件"""
+        """发送邮件，返回每个收件人的 DeliveryResult 列表"""
         smtp_server = self.config.get('smtp_server')
-        smtp_port = self.config.get('smtp_port', 587)
         email_user = self.config.get('email_user')
         email_password = self.config.get('email_password')
         
         if not all([smtp_server, email_user, email_password]):
             logger.error("邮箱配置不完整")
-            return False
+            return [DeliveryResult(email, error="邮箱配置不完整") for email in to_emails]
         
-        success_count = 0
+        # 正文只编码一次，每个收件人只替换 To 头
+        message = EncodedMessage(email_user, subject, html_content)
+        return self.deliver_message(to_emails, message)
+    
+    def deliver_message(self, to_emails, message, on_result=None):
+        """把已编码的邮件投递给每个收件人，返回 DeliveryResult 列表"""
+        smtp_server = self.config.get('smtp_server')
         
-        # 为每个收件人单独发送邮件
-        for email in to_emails:
-            try:
-                # 为每个收件人建立独立的SMTP连接
-                server = smtplib.SMTP(smtp_server, smtp_port)
-                server.starttls()  # 启用TLS加密
-                server.login(email_user, email_password)
-                
-                # 创建邮件
-                msg = MIMEMultipart('alternative')
-                
-                # QQ邮箱要求From字段必须是登录邮箱
-                msg['From'] = email_user
-                msg['To'] = email
-                msg['Subject'] = Header(subject, 'utf-8')
-                
-                # 添加HTML内容
-                html_part = MIMEText(html_content, 'html', 'utf-8')
-                msg.attach(html_part)
-                
-                text = msg.as_string()
-                server.sendmail(email_user, [email], text)
-                server.quit()
-                
-                logger.info(f"邮件发送成功: {email}")
-                success_count += 1
-                
-                # 在发送间隔之间稍作停顿，避免被服务器限制
-                time.sleep(1)
-                
-            except Exception as e:
-                logger.error(f"发送到 {email} 失败: {e}")
+        # 为每个收件人单独发送邮件，多个线程并行投递，同一批次复用已登录的SMTP连接
+        with self.smtp_batch():
+            engine = DeliveryEngine(self.get_smtp_pool(),
+                                    workers=self.config.get('smtp_workers', 2),
+                                    rate_limiter=self.get_rate_limiter(smtp_server),
+                                    max_retries=self.config.get('smtp_max_retries', 3),
+                                    retry_delay=self.config.get('smtp_retry_delay', 2),
+                                    metrics=self.metrics)
+            return engine.deliver(self.config.get('email_user'), to_emails, message.for_recipient,
+                                  on_result=on_result)
+    
+    def get_spool(self):
+        """配置了 spool_file 时返回发件队列"""
+        if not self.config.get('spool_file'):
+            return None
+        with self._lock:
+            if self._spool is None:
+                self._spool = MailSpool(self.config['spool_file'],
+                                        commit_every=self.config.get('spool_commit_every', 100))
+            return self._spool
+    
+    def iter_recipients(self, recipients=None):
+        """逐个返回标准化的收件人 {"email", "city_code", "send_times", "timezone"}
+        
+        收件人可以是邮箱字符串（使用默认 city_code 和 send_times），也可以是带
+        city_code / send_times / timezone 的字典；另外支持 recipient_groups 按组配置
+        """
+        defaults = {
+            'city_code': self.config.get('city_code', '101010100'),
+            'send_times': self.config.get('send_times', ['09:00']),
+            'timezone': self.config.get('timezone')
+        }
+        
+        if recipients is None:
+            recipients = self.config.get('recipients', [])
+            for group in self.config.get('recipient_groups', []):
+                group_defaults = {key: group.get(key, value) for key, value in defaults.items()}
+                for recipient in group.get('recipients', []):
+                    if isinstance(recipient, dict):
+                        if recipient.get('email'):
+                            yield dict(group_defaults, **recipient)
+                    elif recipient:
+                        yield dict(group_defaults, email=recipient)
+        
+        for recipient in recipients:
+            if isinstance(recipient, dict):
+                if recipient.get('email'):
+                    yield dict(defaults, **recipient)
+            elif recipient:
+                yield dict(defaults, email=recipient)
+    
+    def group_recipients(self, recipients=None):
+        """按城市对收件人分组，返回 {city_code: [email, ...]}"""
+        groups = {}
+        for recipient in self.iter_recipients(recipients):
+            groups.setdefault(recipient['city_code'], []).append(recipient['email'])
+        return groups
+    
+    def get_weather_batch(self, city_codes):
+        """并发获取多个城市的天气，每个城市只请求一次，返回 {city_code: weather_data}
+        
+        所有接口请求共用同一个线程池，并发数由 fetch_workers 限制
+        """
+        if not self.config.get('weather_api_key'):
+            logger.error("未配置天气API密钥")
+            return {}
+        
+        city_codes = list(dict.fromkeys(city_codes))
+        pending = [(city_code, self.submit_weather(city_code)) for city_code in city_codes]
+        weather_by_city = {city_code: self.resolve_weather(city_code, futures) for city_code, futures in pending}
+        self.save_state()
+        return weather_by_city
+    
+    def format_subject(self, weather_data):
+        """生成邮件主题"""
+        weather_data = WeatherReport.coerce(weather_data)
+        current = weather_data.current
+        subject = f"🐦 小麻雀天气助手：{display(current.text, '未知')} {display(current.temp)}°C"
+        if weather_data.stale_since:
+            subject += f"（{datetime.fromtimestamp(weather_data.stale_since).strftime('%H:%M')}数据）"
+        return subject
+    
+    def pick_tip(self, run_key):
+        """按 run_key 确定本次发送的贴心提醒，同一次发送所有收件人相同，便于复用渲染结果"""
+        digest = hashlib.sha256(run_key.encode('utf-8')).digest()
+        return DAILY_TIPS[int.from_bytes(digest[:4], 'big') % len(DAILY_TIPS)]
+    
+    def render_message(self, weather_data, tip):
+        """渲染并编码邮件，邮件内容相同时直接复用缓存
+        
+        缓存键只包含实际显示的内容：实况字段、前4天预报，以及 AQI、降雨提醒、温馨提醒、快照时间和日期，
+        观测时间（obsTime）、逐小时预报原始数据等不显示的字段不同不影响复用
+        """
+        email_user = self.config.get('email_user')
+        date_text = datetime.now().strftime('%Y年%m月%d日 %A')
+        weather_data = WeatherReport.coerce(weather_data)
+        render_inputs = self.get_render_inputs(weather_data, tip, date_text)
+        current = weather_data.current
+        key = RenderCache.make_key(
+            email_user,
+            [current.temp, current.text, current.wind_dir, current.wind_scale, current.humidity, current.vis],
+            [day.to_api() for day in weather_data.forecast[:4]],
+            render_inputs)
+        message = self.render_cache.get(key)
+        if message is not None:
+            self.metrics.inc('render_cache_hits_total')
+            return key, message
+        
+        self.metrics.inc('render_cache_misses_total')
+        with self.metrics.timer('render_seconds'):
+            html_content = render_weather_html(weather_data, *render_inputs)
+        message = EncodedMessage(email_user, self.format_subject(weather_data), html_content)
+        self.render_cache.set(key, message)
+        return key, message
+    
+    def prefetch_weather(self, recipients=None):
+        """提前获取收件人所在城市的天气，返回 {city_code: weather_data}"""
+        return self.get_weather_batch(self.group_recipients(recipients))
+    
+    def send_weather_email(self, recipients=None, weather_by_city=None, run_key=None, mode=None):
+        """发送天气邮件，多个城市时按城市分组，每个城市只获取一次天气
+        
+        weather_by_city 为提前获取的天气数据，缺少的城市再实时获取；
+        run_key 标识一次发送（默认为当天日期），配置发件队列时同一 run_key 重新运行只补发未发送的收件人；
+        mode（默认取配置 run_mode）为 batch 时依次获取、渲染、发送，为 pipeline 时三个阶段流水线并行；
+        结束后按配置导出运行指标，返回本次运行的统计
+        """
+        mode = mode or self.config.get('run_mode', 'batch')
+        run = {
+            'run_key': run_key or datetime.now(self.get_timezone()).strftime('%Y-%m-%d'),
+            'mode': mode,
+            'started_at': datetime.now().astimezone().isoformat(timespec='seconds'),
+            'recipients': 0,
+            'cities': 0,
+            'renders': 0,
+            'already_sent': 0,
+            'skipped': 0,
+            'delivered': 0,
+            'failed': 0
+        }
+        start = time.perf_counter()
+        try:
+            if mode == 'pipeline':
+                import asyncio
+                asyncio.run(self.run_pipeline(recipients, weather_by_city, run))
+            else:
+                self.run_weather_email(recipients, weather_by_city, run)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.metrics.observe('send_run_seconds', elapsed)
+            run['duration_seconds'] = round(elapsed, 3)
+            self.export_metrics(run)
+        return run
+    
+    def plan_run(self, recipients, run):
+        """按城市分组收件人并检查邮箱配置，返回需要获取和渲染的 {city_code: [email, ...]}，无法发送时返回 None
+        
+        发件队列中已有的收件人（上次运行中断前已入队）不再重新渲染
+        """
+        groups = self.group_recipients(recipients)
+        if not groups:
+            logger.warning("没有配置邮件接收人")
+            return None
+        run['cities'] = len(groups)
+        run['recipients'] = sum(len(emails) for emails in groups.values())
+        
+        if not all([self.config.get('smtp_server'), self.config.get('email_user'),
+                    self.config.get('email_password')]):
+            logger.error("邮箱配置不完整")
+            run['failed'] = run['recipients']
+            return None
+        
+        spool = self.get_spool()
+        if spool is not None:
+            queued = spool.known_recipients(run['run_key'])
+            if queued:
+                logger.info(f"发件队列中已有 {len(queued)} 个收件人（{run['run_key']}），只补发未发送的邮件")
+                groups = {city_code: [email for email in emails if email not in queued]
+                          for city_code, emails in groups.items()}
+                groups = {city_code: emails for city_code, emails in groups.items() if emails}
+        return groups
+    
+    def spool_delivery(self, spool, message, rows):
+        """发件队列中同一封邮件的记录 [(记录id, 收件人), ...] -> (收件人列表, 邮件, 记录投递结果的回调)"""
+        message_ids = [message_id for message_id, _ in rows]
+        return ([email for _, email in rows], message,
+                lambda index, result: spool.record(message_ids[index], result))
+    
+    def finish_run(self, spool, run):
+        """提交发件队列的状态、清理超过保留期（spool_retention_days，默认7天）的发送并输出结果"""
+        if spool is not None:
+            spool.flush()
+            run['already_sent'] = spool.counts(run['run_key']).get('sent', 0) - run['delivered']
+            retention_days = self.config.get('spool_retention_days', 7)
+            if retention_days:
                 try:
-                    server.quit()
-                except:
-                    pass
+                    pruned = spool.prune(retention_days * 86400)
+                    if pruned:
+                        logger.info(f"发件队列清理了 {pruned} 条超过 {retention_days} 天的记录")
+                except Exception as e:
+                    logger.warning(f"清理发件队列失败: {e}")
         
-        return success_count > 0
+        if run['delivered'] or run['already_sent']:
+            logger.info("天气邮件发送完成")
+        else:
+            logger.error("天气邮件发送失败")
     
-    def send_weather_email(self):
-        """发送天气邮件"""
+    def run_weather_email(self, recipients, weather_by_city, run):
+        """获取天气、渲染并发送，统计结果写入 run"""
         logger.info("开始发送天气邮件...")
         
+        groups = self.plan_run(recipients, run)
+        if groups is None:
+            return
+        spool = self.get_spool()
+        
         # 获取天气信息
-        weather_data = self.get_weather()
+        weather_by_city = dict(weather_by_city or {})
+        missing = [city_code for city_code in groups if not weather_by_city.get(city_code)]
+        if missing:
+            weather_by_city.update(self.get_weather_batch(missing))
         
-        if not weather_data:
-            logger.error("获取天气信息失败，取消发送")
-            return
+        # 按渲染结果分组：天气相同的城市共用一封渲染好的邮件，正文只编码一次
+        tip = self.pick_tip(run['run_key'])
+        rendered = OrderedDict()  # 内容哈希 -> (收件人列表, EncodedMessage)
+        for city_code, emails in groups.items():
+            weather_data = weather_by_city.get(city_code)
+            if not weather_data:
+                logger.error(f"获取天气信息失败，取消发送: {city_code}")
+                run['skipped'] += len(emails)
+                continue
+            
+            key, message = self.render_message(weather_data, tip)
+            if key in rendered:
+                rendered[key][0].extend(emails)
+            else:
+                rendered[key] = (list(emails), message)
+        outbox = list(rendered.values())
+        run['renders'] = len(outbox)
         
-        # 格式化邮件内容
-        html_content = self.format_weather_html(weather_data)
+        # 先写入发件队列，再从队列取出所有未发送的邮件
+        deliveries = [(emails, message, None) for emails, message in outbox]
+        if spool is not None:
+            spool.enqueue(run['run_key'], outbox)
+            deliveries = [self.spool_delivery(spool, message, rows)
+                          for message, rows in spool.unsent(run['run_key'])]
         
-        # 获取收件人列表
-        recipients = self.config.get('recipients', [])
-        if not recipients:
-            logger.warning("没有配置邮件接收人")
+        # 发送邮件
+        with self.smtp_batch():
+            for emails, message, on_result in deliveries:
+                results = self.deliver_message(emails, message, on_result)
+                delivered = sum(result.success for result in results)
+                run['delivered'] += delivered
+                run['failed'] += len(results) - delivered
+        
+        self.finish_run(spool, run)
+    
+    async def run_pipeline(self, recipients, weather_by_city, run):
+        """流水线模式：获取天气、渲染、发送三个阶段并行，阶段之间用有界队列连接
+        
+        第一个城市获取完成后就开始渲染和发送，不必等所有城市都获取完；队列满时上游阶段等待（背压），
+        排队等待发送的邮件数量由 pipeline_queue_size 限制而不是收件人数（渲染缓存另按 render_cache_max_bytes 限制）；
+        各阶段的吞吐和利用率写入 run['pipeline']
+        """
+        import asyncio
+        logger.info("开始发送天气邮件（流水线模式）...")
+        
+        groups = self.plan_run(recipients, run)
+        if groups is None:
             return
+        spool = self.get_spool()
+        run_key = run['run_key']
+        tip = self.pick_tip(run_key)
+        weather_by_city = weather_by_city or {}
+        has_api_key = bool(self.config.get('weather_api_key'))
+        if not has_api_key and any(city_code not in weather_by_city for city_code in groups):
+            logger.error("未配置天气API密钥")
+        
+        queue_size = self.config.get('pipeline_queue_size', 16)
+        deliver_batch = self.config.get('pipeline_deliver_batch', 1000)
+        fetched = asyncio.Queue(queue_size)  # (city_code, 收件人列表, weather_data)
+        rendered = asyncio.Queue(queue_size)  # (收件人列表, EncodedMessage, on_result)
+        stages = {
+            'fetch': StageStats('fetch', self.config.get('pipeline_fetch_concurrency',
+                                                         self.config.get('fetch_workers', 16)), self.metrics),
+            'render': StageStats('render', 1, self.metrics),
+            'deliver': StageStats('deliver', self.config.get('pipeline_deliver_concurrency', 2), self.metrics)
+        }
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
         
-        # 生成邮件主题
-        current = weather_data['current']
-        subject = f"🐦 小麻雀天气助手：{current.get('text', '未知')} {current.get('temp', 'N/A')}°C"
+        # 上次中断留下的未发送邮件要在本次新入队之前取出，避免重复发送
+        resumed = []
+        if spool is not None:
+            resumed = [self.spool_delivery(spool, message, rows) for message, rows in spool.unsent(run_key)]
         
-        # 发送邮件
-        success = self.send_email(recipients, subject, html_content)
+        cities = iter(groups.items())
+        render_keys = set()
         
-        if success:
-            logger.info("天气邮件发送完成")
+        async def fetch_worker():
+            for city_code, emails in cities:
+                with stages['fetch'].track():
+                    weather_data = weather_by_city.get(city_code)
+                    if not weather_data and has_api_key:
+                        futures = self.submit_weather(city_code)
+                        await asyncio.wait([asyncio.wrap_future(future) for future in futures.values()])
+                        try:
+                            weather_data = self.resolve_weather(city_code, futures)
+                        except Exception as e:
+                            logger.error(f"获取天气异常: {city_code}: {e}")
+                await fetched.put((city_code, emails, weather_data))
+        
+        async def render_worker():
+            finished = False
+            while not finished:
+                # 取出队列中已获取的所有城市一起渲染，发件队列每批只提交一次事务
+                items = [await fetched.get()]
+                while len(items) < queue_size and not fetched.empty():
+                    items.append(fetched.get_nowait())
+                if items[-1] is None:
+                    items.pop()
+                    finished = True
+                
+                outbox = []
+                for city_code, emails, weather_data in items:
+                    if not weather_data:
+                        logger.error(f"获取天气信息失败，取消发送: {city_code}")
+                        run['skipped'] += len(emails)
+                        continue
+                    try:
+                        with stages['render'].track():
+                            key, message = self.render_message(weather_data, tip)
+                    except Exception as e:
+                        logger.error(f"渲染邮件失败，取消发送: {city_code}: {e}")
+                        run['skipped'] += len(emails)
+                        continue
+                    render_keys.add(key)
+                    outbox.append((emails, message))
+                
+                deliveries = [(emails, message, None) for emails, message in outbox]
+                if spool is not None and outbox:
+                    # 写入发件队列需要 fsync，放到线程池中执行，不阻塞事件循环
+                    try:
+                        queued = await loop.run_in_executor(None, spool.enqueue, run_key, outbox)
+                    except Exception as e:
+                        logger.error(f"写入发件队列失败，取消发送: {e}")
+                        run['skipped'] += sum(len(emails) for emails, _ in outbox)
+                        continue
+                    deliveries = [self.spool_delivery(spool, message, rows)
+                                  for (_, message), rows in zip(outbox, queued)]
+                for delivery in deliveries:
+                    if delivery[0]:
+                        await rendered.put(delivery)
+        
+        async def deliver_worker():
+            carried = []  # 上一轮没能合并的投递（收件人重复）或结束标记
+            while True:
+                item = carried.pop() if carried else await rendered.get()
+                if item is None:
+                    return
+                
+                # 发送跟不上时队列里会积压多组，合并为一次投递
+                batch = MergedDelivery()
+                batch.add(*item)
+                while len(batch.emails) < deliver_batch and not rendered.empty():
+                    item = rendered.get_nowait()
+                    if item is None or not batch.add(*item):
+                        carried.append(item)
+                        break
+                emails = batch.emails
+                try:
+                    with stages['deliver'].track(len(emails)):
+                        results = await loop.run_in_executor(None, self.deliver_message, emails, batch,
+                                                             batch.on_result)
+                except Exception as e:
+                    logger.error(f"发送异常: {e}")
+                    run['failed'] += len(emails)
+                    continue
+                delivered = sum(result.success for result in results)
+                run['delivered'] += delivered
+                run['failed'] += len(results) - delivered
+                if 'first_delivery_seconds' not in run:
+                    run['first_delivery_seconds'] = round(time.perf_counter() - start, 3)
+        
+        # 整个流水线期间保持SMTP连接池，各组邮件复用已登录的连接
+        with self.smtp_batch():
+            deliverers = [asyncio.ensure_future(deliver_worker()) for _ in range(stages['deliver'].workers)]
+            renderer = asyncio.ensure_future(render_worker())
+            try:
+                for delivery in resumed:
+                    await rendered.put(delivery)
+                await asyncio.gather(*(fetch_worker() for _ in range(stages['fetch'].workers)))
+                await fetched.put(None)
+                await loop.run_in_executor(None, self.save_state)
+                await renderer
+                for _ in deliverers:
+                    await rendered.put(None)
+                await asyncio.gather(*deliverers)
+            finally:
+                for task in deliverers + [renderer]:
+                    task.cancel()
+        
+        wall_seconds = time.perf_counter() - start
+        run['renders'] = len(render_keys)
+        run['pipeline'] = {name: stage.summary(wall_seconds) for name, stage in stages.items()}
+        for name, summary in run['pipeline'].items():
+            logger.info(f"流水线阶段 {name}: {summary['items']} 项, {summary['per_second']:.1f} 项/秒, "
+                        f"利用率 {summary['utilization']:.0%}")
+        bottleneck = max(run['pipeline'], key=lambda name: run['pipeline'][name]['utilization'])
+        logger.info(f"瓶颈阶段: {bottleneck}")
+        
+        self.finish_run(spool, run)
+    
+    def dry_run(self, output_dir='.', offline=False, recipients=None):
+        """只渲染不发送：每个城市的邮件HTML写入 output_dir/weather_<城市>.html，返回文件路径列表
+        
+        offline 时不请求接口，直接使用 snapshot_file 中保存的天气快照，便于本地快速调整模板
+        """
+        groups = self.group_recipients(recipients) or {self.config.get('city_code', '101010100'): []}
+        if offline:
+            weather_by_city = {city_code: self.snapshots.get(city_code)[1] for city_code in groups}
         else:
-            logger.error("天气邮件发送失败")
+            weather_by_city = self.get_weather_batch(groups)
+        
+        tip = self.pick_tip(datetime.now(self.get_timezone()).strftime('%Y-%m-%d'))
+        os.makedirs(output_dir, exist_ok=True)
+        paths = []
+        for city_code, emails in groups.items():
+            weather_data = weather_by_city.get(city_code)
+            if not weather_data:
+                logger.error(f"没有可用的天气数据: {city_code}")
+                continue
+            path = os.path.join(output_dir, f"weather_{city_code}.html")
+            write_file_atomic(path, self.format_weather_html(weather_data, tip))
+            logger.info(f"{self.format_subject(weather_data)} -> {path}（{len(emails)} 个收件人）")
+            paths.append(path)
+        return paths
+    
+    def export_metrics(self, run=None):
+        """导出运行指标：metrics_file 写 Prometheus 文本格式，run_summary_file 写本次运行的 JSON 摘要"""
+        metrics_file = self.config.get('metrics_file')
+        summary_file = self.config.get('run_summary_file')
+        try:
+            if metrics_file:
+                write_file_atomic(metrics_file, self.metrics.to_prometheus())
+            if summary_file:
+                summary = dict(run or {}, metrics=self.metrics.summary())
+                write_file_atomic(summary_file, json.dumps(summary, ensure_ascii=False, indent=2))
+        except OSError as e:
+            logger.warning(f"导出运行指标失败: {e}")
+    
+    def get_timezone(self):
+        """获取配置的时区（timezone，如 Asia/Shanghai），未配置时使用本机时区"""
+        timezone_name = self.config.get('timezone')
+        if timezone_name:
+            return load_timezone(timezone_name)
+        return datetime.now().astimezone().tzinfo
+    
+    def next_send_time(self, send_times, now):
+        """计算 now 之后最近的一次发送时间，send_times 为 HH:MM 或 HH:MM:SS"""
+        candidates = []
+        for send_time in send_times:
+            parts = [int(part) for part in send_time.split(':')]
+            at = now.replace(hour=parts[0], minute=parts[1], second=parts[2] if len(parts) > 2 else 0,
+                             microsecond=0)
+            if at <= now:
+                at += timedelta(days=1)
+            candidates.append(at)
+        return min(candidates)
     
     def start_scheduler(self):
         """启动定时任务"""
-        # 从配置文件读取发送时间
-        send_times = self.config.get('send_times', ['09:00'])
+        import asyncio
+        try:
+            asyncio.run(self.run_scheduler())
+        except KeyboardInterrupt:
+            logger.info("程序已停止")
+    
+    def build_dispatcher(self, now=None):
+        """按每个收件人自己的 send_times 和 timezone 建立发送调度堆"""
+        dispatcher = RecipientDispatcher(self.next_send_time)
+        now = now or datetime.now(self.get_timezone())
+        for recipient in self.iter_recipients():
+            timezone = load_timezone(recipient['timezone']) if recipient['timezone'] else self.get_timezone()
+            dispatcher.add(recipient, recipient['send_times'], timezone, now)
+        return dispatcher
+    
+    async def run_scheduler(self):
+        """事件驱动的定时任务：睡眠到下一个发送时间，提前 prefetch_minutes 分钟获取天气
         
-        for send_time in send_times:
-            schedule.every().day.at(send_time).do(self.send_weather_email)
+        每个收件人可以有自己的发送时间、城市和时区，同一时刻到期的收件人合并为一批发送；
+        发送在线程池中执行，慢的SMTP服务器不会推迟后面的任务
+        """
+        import asyncio
+        prefetch = timedelta(minutes=self.config.get('prefetch_minutes', 5))
+        dispatcher = self.build_dispatcher()
+        if self.config.get('metrics_port'):
+            self.metrics.serve(self.config['metrics_port'])
+        
+        # 从配置文件读取发送时间
+        for send_time in self.config.get('send_times', ['09:00']):
             logger.info(f"已设置定时任务：每天 {send_time} 发送天气邮件")
+        logger.info(f"共 {len(dispatcher)} 个收件人参与定时发送")
+        
+        if not len(dispatcher):
+            logger.warning("没有配置邮件接收人")
+            return
         
         logger.info("定时任务启动，按Ctrl+C停止...")
         
+        running = set()
+        while True:
+            send_at, batch = dispatcher.pop_due_batch()
+            await sleep_until(send_at - prefetch)
+            task = asyncio.create_task(self.run_scheduled_send(send_at, batch))
+            running.add(task)
+            task.add_done_callback(running.discard)
+    
+    async def run_scheduled_send(self, send_at, recipients=None):
+        """一次定时发送：先获取天气，到点后发送"""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        weather_by_city = None
         try:
-            while True:
-                schedule.run_pending()
-                time.sleep(60)  # 每分钟检查一次
-        except KeyboardInterrupt:
-            logger.info("程序已停止")
+            weather_by_city = await loop.run_in_executor(None, self.prefetch_weather, recipients)
+        except Exception as e:
+            logger.warning(f"提前获取天气失败，发送时重新获取: {e}")
+        
+        await sleep_until(send_at)
+        logger.info(f"定时任务触发: {send_at.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+        try:
+            await loop.run_in_executor(None, partial(self.send_weather_email, recipients,
+                                                     weather_by_city=weather_by_city,
+                                                     run_key=send_at.strftime('%Y-%m-%d %H:%M %z')))
+        except Exception as e:
+            logger.error(f"定时发送异常: {e}")
+
+def build_parser():
+    """命令行参数：send（别名 test）立即发送，daemon 定时发送，dry-run 只渲染，bench 运行性能基准"""
+    import argparse
+    parser = argparse.ArgumentParser(prog='weather_email_clean.py', description='小麻雀天气助手')
+    parser.add_argument('--config', default='email_config.json', help='配置文件路径')
+    subparsers = parser.add_subparsers(dest='command', metavar='{send,daemon,dry-run,bench}')
+    
+    send_parser = subparsers.add_parser('send', aliases=['test'], help='立即发送一次天气邮件')
+    send_parser.add_argument('--run-key', help='本次发送的标识（默认当天日期），配置发件队列时用于中断后续发')
+    send_parser.add_argument('--mode', choices=['batch', 'pipeline'],
+                             help='batch 依次获取、渲染、发送；pipeline 三个阶段流水线并行（默认取配置 run_mode）')
+    
+    subparsers.add_parser('daemon', help='按 send_times 定时发送（不带子命令时的默认行为）')
+    
+    dry_run_parser = subparsers.add_parser('dry-run', help='只渲染不发送，邮件HTML写入文件')
+    dry_run_parser.add_argument('--output-dir', default='.', help='HTML输出目录')
+    dry_run_parser.add_argument('--offline', action='store_true',
+                                help='不请求天气接口，使用 snapshot_file 中的天气快照')
+    
+    bench_parser = subparsers.add_parser('bench', help='运行性能基准，其余参数传给 benchmark.py', add_help=False)
+    bench_parser.add_argument('bench_args', nargs=argparse.REMAINDER)
+    return parser
 
-def main():
+def main(argv=None):
     """主函数"""
-    weather_email = WeatherEmail()
+    parser = build_parser()
+    # bench 的参数原样交给 benchmark.py；以选项开头（如 bench --help）时 REMAINDER 收不到，由 parse_known_args 收集
+    args, extra_args = parser.parse_known_args(argv)
+    if args.command == 'bench':
+        import benchmark
+        return benchmark.main(extra_args + args.bench_args)
+    if extra_args:
+        parser.error(f"unrecognized arguments: {' '.join(extra_args)}")
+    
+    weather_email = WeatherEmail(args.config)
     
-    import sys
-    if len(sys.argv) > 1 and sys.argv[1] == 'test':
-        # 测试模式：立即发送一次
-        weather_email.send_weather_email()
-    else:
-        # 正常模式：启动定时任务
-        weather_email.start_scheduler()
+    # 同时写入日志文件（GitHub Actions 会上传为构建产物）
+    log_file = weather_email.config.get('log_file')
+    if log_file:
+        file_handler = logging.FileHandler(log_file, encoding='utf-8')
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        logging.getLogger().addHandler(file_handler)
+    
+    try:
+        if args.command in ('send', 'test'):
+            # 立即发送一次
+            weather_email.send_weather_email(run_key=args.run_key, mode=args.mode)
+        elif args.command == 'dry-run':
+            weather_email.dry_run(args.output_dir, offline=args.offline)
+        else:
+            # 正常模式：启动定时任务
+            weather_email.start_scheduler()
+    finally:
+        weather_email.close()
 
 if __name__ == "__main__":
     main()
-
-